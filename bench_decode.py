@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compare frame decode speed of the numpy path against the legacy putpixel path
+Also verifies they produce identical images
+"""
+
+from faxitron.util import add_bool_arg
+from faxitron import ham
+import numpy as np
+import time
+
+GEOMETRIES = {
+    "dc5": (1032, 1032),
+    "dc12": (2368, 2340),
+}
+
+
+def make_raw(width, height, depth=2):
+    npim = np.random.randint(0, ham.PIX_MAX + 1, size=width * height)
+    return npim.astype('<u2').tobytes()
+
+
+def bench(fn, buff, width, height, loops):
+    tstart = time.time()
+    for _i in range(loops):
+        img = fn(buff, width, height)
+    return img, (time.time() - tstart) / loops
+
+
+def run(geometries, loops=3, slow=True):
+    for name in geometries:
+        width, height = GEOMETRIES[name]
+        buff = make_raw(width, height)
+        print("%s: %ux%u" % (name, width, height))
+        img_fast, dt_fast = bench(ham.decode, buff, width, height, loops)
+        print("  decode:      %0.3f sec" % dt_fast)
+        if not slow:
+            continue
+        # Very slow, don't bother repeating
+        img_slow, dt_slow = bench(ham.decode_slow, buff, width, height, 1)
+        print("  decode_slow: %0.3f sec" % dt_slow)
+        print("  speedup: %0.1fx" % (dt_slow / dt_fast, ))
+        assert img_fast.mode == img_slow.mode, (img_fast.mode, img_slow.mode)
+        assert img_fast.size == img_slow.size, (img_fast.size, img_slow.size)
+        assert np.array_equal(np.array(img_fast), np.array(img_slow))
+        print("  match: ok")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark frame decode')
+    parser.add_argument('--loops', default=3, type=int, help='')
+    add_bool_arg(parser,
+                 '--slow',
+                 default=True,
+                 help='Also run and compare against legacy decoder')
+    parser.add_argument('geometries',
+                        nargs='*',
+                        default=["dc5", "dc12"],
+                        help='dc5 and/or dc12')
+    args = parser.parse_args()
+
+    run(args.geometries, loops=args.loops, slow=args.slow)
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Benchmark im_util numpy implementations against the legacy per pixel versions
+Also verifies they produce identical results on random data
+"""
+
+from faxitron.util import add_bool_arg
+from faxitron import im_util
+from faxitron import clahe
+import numpy as np
+from PIL import Image
+import shutil
+import time
+
+try:
+    from skimage import exposure
+except ImportError:
+    exposure = None
+
+GEOMETRIES = {
+    "dc5": (1032, 1032),
+    "dc12": (2368, 2340),
+}
+
+
+def im_equal(a, b):
+    return a.mode == b.mode and a.size == b.size and np.array_equal(
+        np.array(a), np.array(b))
+
+
+def setup_npf2im(width, height):
+    statef = np.random.uniform(0, 0xFFFF, size=(height, width))
+    # Exercise round half to even
+    statef[0, 0:4] = [0.5, 1.5, 2.5, 0xFFFF]
+    return (statef, )
+
+
+def setup_inv16(width, height):
+    npim = np.random.randint(0, 0x10000, size=(height, width), dtype=np.int32)
+    return (Image.fromarray(npim), )
+
+
+def setup_np_inv16(width, height):
+    npim = np.random.randint(0, 0x10000, size=(height, width), dtype=np.uint16)
+    return (npim, npim)
+
+
+def setup_bpr(width, height):
+    npim = np.random.randint(0, 0x10000, size=(height, width), dtype=np.int32)
+    # ~0.1% bad pixels, including edges and clusters
+    badnp = np.random.uniform(size=(height, width)) < 0.001
+    badnp[0, 0:3] = True
+    badnp[-1, -1] = True
+    badnp[10:12, 10:12] = True
+    badimg = Image.fromarray(badnp)
+    return (Image.fromarray(npim), badimg)
+
+
+def setup_histeq(width, height):
+    # Typical processed image: most values in a band, some clipped
+    npim = np.random.normal(0x8000, 0x1000, size=(height, width))
+    return (np.clip(npim, 0, 0xFFFF).astype(np.uint16), )
+
+
+def np_close(a, b):
+    """Equivalent to within a rounding LSB"""
+    diff = np.abs(a.astype(np.int32) - b.astype(np.int32))
+    print("    max diff: %u, mean diff: %0.3f" % (np.max(diff), np.mean(diff)))
+    return np.max(diff) <= 1
+
+
+def clahe_skimage(npim):
+    ret = exposure.equalize_adapthist(npim / 0xFFFF, clip_limit=0.03)
+    return np.round(ret * 0xFFFF).astype(np.uint16)
+
+
+def np_similar(a, b):
+    """Different algorithm details, but should look about the same"""
+    corr = np.corrcoef(a.ravel(), b.ravel())[0, 1]
+    print("    correlation: %0.4f" % corr)
+    return corr > 0.95
+
+
+"""
+name: (setup(width, height) => args, fast, slow, compare(fast_ret, slow_ret))
+slow None: timing only
+"""
+OPS = {
+    "npf2im": (setup_npf2im, im_util.npf2im, im_util.npf2im_slow, im_equal),
+    "inv16": (setup_inv16, im_util.im_inv16, im_util.im_inv16_slow, im_equal),
+    "bpr": (setup_bpr, im_util.do_bpr, im_util.do_bpr_slow, im_equal),
+    # Against ImageMagick subprocess, skipped if convert isn't installed
+    "histeq_convert":
+    (setup_histeq, im_util.histeq_convert,
+     im_util.histeq_convert_ext if shutil.which("convert") else None,
+     np_close),
+    # Exact LUT equalizer vs legacy 256 bin interpolation (different output)
+    "histeq_lut": (setup_histeq, im_util.histeq_lut, None, None),
+    "histeq_np": (setup_histeq, im_util.histeq_np, None, None),
+    # Against skimage, skipped if not installed
+    "clahe": (setup_histeq, lambda npim: clahe.clahe(npim, clip_limit=0.03),
+              clahe_skimage if exposure else None, np_similar),
+    # In place, as used by array pipelines
+    "np_inv16": (setup_np_inv16, im_util.np_inv16, None, None),
+}
+
+
+def bench(fn, args, loops):
+    tstart = time.time()
+    for _i in range(loops):
+        ret = fn(*args)
+    return ret, (time.time() - tstart) / loops
+
+
+def run(geometries, ops, loops=3, slow=True):
+    for name in geometries:
+        width, height = GEOMETRIES[name]
+        print("%s: %ux%u" % (name, width, height))
+        for op in ops:
+            setup, fast, slow_fn, compare = OPS[op]
+            args = setup(width, height)
+            ret_fast, dt_fast = bench(fast, args, loops)
+            print("  %s: %0.3f sec" % (op, dt_fast))
+            if not slow or slow_fn is None:
+                continue
+            # Very slow, don't bother repeating
+            ret_slow, dt_slow = bench(slow_fn, args, 1)
+            print("    slow: %0.3f sec, speedup: %0.1fx" %
+                  (dt_slow, dt_slow / dt_fast))
+            assert compare(ret_fast, ret_slow), op
+            print("    match: ok")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark image utilities')
+    parser.add_argument('--loops', default=3, type=int, help='')
+    parser.add_argument('--geometry',
+                        action='append',
+                        default=None,
+                        help='dc5 and/or dc12 (default: both)')
+    add_bool_arg(parser,
+                 '--slow',
+                 default=True,
+                 help='Also run and compare against legacy implementation')
+    parser.add_argument('ops',
+                        nargs='*',
+                        default=None,
+                        help='%s (default: all)' % ', '.join(OPS))
+    args = parser.parse_args()
+
+    run(args.geometry or ["dc5", "dc12"],
+        args.ops or list(OPS),
+        loops=args.loops,
+        slow=args.slow)
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Compare sensor time to first frame using the full pcap replay init vs fast init
+Needs the sensor attached
+"""
+
+from faxitron import ham
+import time
+
+MODES = {
+    "full": False,
+    "fast": True,
+}
+
+
+def time_to_first_frame(fast, exp_ms):
+    """Return seconds for (open + reset, init, first frame)"""
+    tstart = time.time()
+    h = ham.Hamamatsu(exp_ms=exp_ms, init=False)
+    topen = time.time()
+    try:
+        h.width, h.height = h.init(fast=fast)
+        if not fast:
+            # Full init leaves exposure at its own default
+            h.set_exp(exp_ms)
+        tinit = time.time()
+        h.cap(lambda _n, _buff: None, n=1)
+        tframe = time.time()
+    finally:
+        h.close()
+    return topen - tstart, tinit - topen, tframe - tinit
+
+
+def run(modes, loops=3, exp_ms=100):
+    for mode in modes:
+        print("%s init" % mode)
+        totals = [0.0, 0.0, 0.0]
+        for loop in range(loops):
+            dts = time_to_first_frame(MODES[mode], exp_ms)
+            print("  %u: open %0.3f, init %0.3f, frame %0.3f, total %0.3f" %
+                  (loop, dts[0], dts[1], dts[2], sum(dts)))
+            totals = [t + dt for t, dt in zip(totals, dts)]
+        print("  average: open %0.3f, init %0.3f, frame %0.3f, total %0.3f" %
+              (totals[0] / loops, totals[1] / loops, totals[2] / loops,
+               sum(totals) / loops))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark sensor init time to first frame')
+    parser.add_argument('--loops', default=3, type=int, help='')
+    parser.add_argument('--exp', default=100, type=int, help='Exposure ms')
+    parser.add_argument('modes',
+                        nargs='*',
+                        default=None,
+                        help='%s (default: all)' % ', '.join(MODES))
+    args = parser.parse_args()
+
+    run(args.modes or list(MODES), loops=args.loops, exp_ms=args.exp)
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmark the x-ray serial driver against the software emulator
+No hardware needed
+"""
+
+from faxitron import xray
+from faxitron import xray_emu
+from faxitron.util import add_bool_arg
+import time
+
+
+def status_serial(xr):
+    return {
+        "dev": xr.get_device(),
+        "rev": xr.get_revision(),
+        "mode": xr.get_mode(),
+        "state": xr.get_state(),
+        "timed": xr.get_timed(),
+        "kvp": xr.get_kvp(),
+    }
+
+
+def status_batch(xr):
+    return xr.get_json()
+
+
+def setup_burst(xr):
+    # What a burst loop does every cycle
+    # Settings are only cached in remote mode
+    xr.mode_remote()
+    xr.set_kvp(30)
+    xr.set_timed(1)
+    xr.fire(timeout=1.0)
+
+
+"""
+name: (fn(xr), XRay kwargs)
+"""
+OPS = {
+    "status_serial": (status_serial, {}),
+    "status_batch": (status_batch, {}),
+    "burst_nocache": (setup_burst, {
+        "cache_ttl": 0
+    }),
+    "burst_cache": (setup_burst, {}),
+}
+
+
+def bench(op, loops, emu_kwargs):
+    fn, xr_kwargs = OPS[op]
+    with xray_emu.XRayEmulator(**emu_kwargs) as emu:
+        xr = xray.XRay(port=emu.port, **xr_kwargs)
+        # Warm caches like a long running script would
+        fn(xr)
+        xr.reset_stats()
+        commands = emu.stats["commands"]
+        tstart = time.time()
+        for _i in range(loops):
+            ret = fn(xr)
+        dt = (time.time() - tstart) / loops
+        stats = xr.latency_stats()
+        print("  %s: %0.1f ms, %0.1f commands, retries %u" %
+              (op, dt * 1000,
+               (emu.stats["commands"] - commands) / loops, stats["retries"]))
+        xr.serial.close()
+    return ret
+
+
+def check_drop_once(loops=5, emu_kwargs={}):
+    """
+    A single dropped query should only slow down the call that retried it
+    """
+    with xray_emu.XRayEmulator(**emu_kwargs) as emu:
+        xr = xray.XRay(port=emu.port)
+        emu.drop_once("?V")
+        xr.get_kvp()
+        assert xr.stats["retries"] == 1, xr.stats["retries"]
+        xr.reset_stats()
+        tstart = time.time()
+        for _i in range(loops):
+            xr.get_kvp()
+        dt = (time.time() - tstart) / loops
+        stats = xr.latency_stats()
+        print("  drop_once: get_kvp %0.1f ms, retries %u" %
+              (dt * 1000, stats["retries"]))
+        xr.serial.close()
+    assert stats["retries"] == 0, stats["retries"]
+    # Normal latency, not waiting out a timeout
+    assert dt < 0.5, dt
+
+
+def run(ops, loops=5, emu_kwargs={}, check=True):
+    print("Emulator: %s" % (emu_kwargs, ))
+    for op in ops:
+        bench(op, loops, emu_kwargs)
+    if check:
+        check_drop_once(loops, emu_kwargs)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark x-ray driver against emulator')
+    parser.add_argument('--loops', default=5, type=int, help='')
+    parser.add_argument('--baud', default=9600, type=int, help='')
+    parser.add_argument('--delay',
+                        default=0.01,
+                        type=float,
+                        help='Emulated reply latency')
+    parser.add_argument('--ff-rate', default=0.0, type=float, help='')
+    parser.add_argument('--drop-rate', default=0.0, type=float, help='')
+    add_bool_arg(parser,
+                 "--check",
+                 default=True,
+                 help="Check recovery from a single dropped query")
+    parser.add_argument('ops',
+                        nargs='*',
+                        default=None,
+                        help='%s (default: all)' % ', '.join(OPS))
+    args = parser.parse_args()
+
+    run(args.ops or list(OPS),
+        loops=args.loops,
+        check=args.check,
+        emu_kwargs={
+            "baud": args.baud,
+            "reply_delay": args.delay,
+            "ff_rate": args.ff_rate,
+            "drop_rate": args.drop_rate,
+            "seed": 0,
+        })
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -34,43 +34,31 @@ def bad_pixs_ff1(fff, ffi):
 """
 
 
-def bad_pixs_ff(fff, ffi, thresh_scalar=0.25):
+def bad_pixs_ff(fff, thresh_scalar=0.25):
+    """Return mask of cold pixels in averaged flat field"""
     ffmed = np.median(fff)
     print("min: %0.1f, med: %0.1f, max: %0.1f" %
           (np.amin(fff), ffmed, np.amax(fff)))
 
-    ret = []
-    width, height = ffi.size
     thresh = ffmed * thresh_scalar
-    for y in range(height):
-        for x in range(width):
-            val = ffi.getpixel((x, y))
-            if 0 and y == 0 and x < 16:
-                print(x, y, val)
-            if val <= thresh:
-                ret.append((x, y))
-
-    print("Cold pixels: %u / %u" % (len(ret), width * height))
+    # Compare the pixel values as saved to ff.png
+    ret = np.round(fff) <= thresh
+
+    print("Cold pixels: %u / %u" % (np.count_nonzero(ret), ret.size))
     return ret
 
 
-def bad_pixs_df(fff, ffi, thresh_scalar=0.25):
-    ffmed = np.median(fff)
+def bad_pixs_df(dff, thresh_scalar=0.25):
+    """Return mask of hot pixels in averaged dark field"""
+    dfmed = np.median(dff)
     print("min: %0.1f, med: %0.1f, max: %0.1f" %
-          (np.amin(fff), ffmed, np.amax(fff)))
+          (np.amin(dff), dfmed, np.amax(dff)))
 
-    ret = []
-    width, height = ffi.size
     thresh = ham.PIX_MAX * thresh_scalar
-    for y in range(height):
-        for x in range(width):
-            val = ffi.getpixel((x, y))
-            if 0 and y == 0 and x < 16:
-                print(x, y, val)
-            if val >= thresh:
-                ret.append((x, y))
-
-    print("Hot pixels: %u / %u" % (len(ret), width * height))
+    # Compare the pixel values as saved to df.png
+    ret = np.round(dff) >= thresh
+
+    print("Hot pixels: %u / %u" % (np.count_nonzero(ret), ret.size))
     return ret
 
 
@@ -98,19 +86,17 @@ def main():
     mkdir_p(cal_dir)
 
     fff, ffi = im_util.average_dir(args.ff_dir, images=args.images)
-    width, height = ffi.size
-    badimg = Image.new("1", (width, height), "Black")
     ffi.save(cal_dir + '/ff.png')
     im_util.histeq_im(ffi).save(cal_dir + '/ffe.png')
-    for x, y in bad_pixs_ff(fff, ffi, thresh_scalar=args.ff_thresh):
-        badimg.putpixel((x, y), 1)
+    badnp = bad_pixs_ff(fff, thresh_scalar=args.ff_thresh)
 
     dff, dfi = im_util.average_dir(args.df_dir, images=args.images)
     dfi.save(cal_dir + '/df.png')
     im_util.histeq_im(dfi).save(cal_dir + '/dfe.png')
-    for x, y in bad_pixs_df(dff, dfi, thresh_scalar=args.df_thresh):
-        badimg.putpixel((x, y), 1)
+    badnp |= bad_pixs_df(dff, thresh_scalar=args.df_thresh)
 
+    # bool array => mode "1": black good pixel, white bad pixel
+    badimg = Image.fromarray(badnp)
     badimg.save(cal_dir + '/bad.png')
 
     print("done")
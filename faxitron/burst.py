@@ -0,0 +1,177 @@
+"""
+Single file container for a burst of raw sensor frames
+
+256 byte header (see HEADER_FMT) followed by one record per frame:
+raw frame as received from the sensor (little endian uint16, not rotated)
+then uint16 counter and uint16 average from the end of frame message
+
+Records are fixed size so the file can be appended to and memory mapped
+"""
+
+from faxitron import ham
+import numpy as np
+import os
+import struct
+
+MAGIC = b"FAXBURST"
+VERSION = 1
+# magic, version, header size, width, height, depth, exp_ms, kvp, model, sn
+HEADER_FMT = "<8sIIIIIII32s32s"
+HEADER_SZ = 256
+# Default file name in a capture dir
+BURST_FN = "cap.raw"
+
+
+def pack_str(s):
+    return s.encode("ascii")[0:32]
+
+
+def unpack_str(b):
+    return b.rstrip(b"\x00").decode("ascii")
+
+
+def record_dtype(width, height):
+    return np.dtype([
+        ("img", "<u2", (height, width)),
+        ("counter", "<u2"),
+        ("average", "<u2"),
+    ])
+
+
+def read_header(f):
+    buff = f.read(HEADER_SZ)
+    if len(buff) != HEADER_SZ:
+        raise ValueError("Truncated header")
+    (magic, version, header_sz, width, height, depth, exp_ms, kvp, model,
+     sn) = struct.unpack(HEADER_FMT, buff[0:struct.calcsize(HEADER_FMT)])
+    if magic != MAGIC:
+        raise ValueError("Bad magic")
+    if version != VERSION:
+        raise ValueError("Unsupported version %u" % version)
+    assert header_sz == HEADER_SZ, header_sz
+    assert depth == 2, depth
+    return {
+        "width": width,
+        "height": height,
+        "depth": depth,
+        "exp_ms": exp_ms,
+        "kvp": kvp,
+        "model": unpack_str(model),
+        "sn": unpack_str(sn),
+    }
+
+
+class BurstWriter:
+    """
+    Write frames to a burst file
+    append: add to an existing file, which requires a matching header
+    Otherwise any existing file is replaced
+    """
+    def __init__(self,
+                 fn,
+                 width,
+                 height,
+                 depth=2,
+                 exp_ms=0,
+                 kvp=0,
+                 model="",
+                 sn="",
+                 append=True):
+        assert depth == 2
+        self.fn = fn
+        self.header = {
+            "width": width,
+            "height": height,
+            "depth": depth,
+            "exp_ms": exp_ms,
+            "kvp": kvp,
+            "model": model,
+            "sn": sn,
+        }
+        self.imgsz = width * height * depth
+        self.record_sz = record_dtype(width, height).itemsize
+
+        if append and os.path.exists(fn) and os.path.getsize(fn):
+            self.f = open(fn, "r+b")
+            try:
+                header = read_header(self.f)
+                for k in ("width", "height", "depth", "model", "sn"):
+                    if header[k] != self.header[k]:
+                        raise ValueError("%s: %s mismatch (%s vs %s)" %
+                                         (fn, k, header[k], self.header[k]))
+            except BaseException:
+                self.f.close()
+                raise
+            # Drop partial record from an interrupted capture
+            n = (os.path.getsize(fn) - HEADER_SZ) // self.record_sz
+            self.f.truncate(HEADER_SZ + n * self.record_sz)
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(fn, "wb")
+            buff = struct.pack(HEADER_FMT, MAGIC, VERSION, HEADER_SZ, width,
+                               height, depth, exp_ms, kvp, pack_str(model),
+                               pack_str(sn))
+            self.f.write(buff + b"\x00" * (HEADER_SZ - len(buff)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, rawimg, counter=0, average=0):
+        assert len(rawimg) == self.imgsz, (len(rawimg), self.imgsz)
+        self.f.write(rawimg)
+        self.f.write(struct.pack("<HH", counter, average))
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+
+class Burst:
+    """
+    Memory mapped burst file
+    frames: (n, height, width) uint16, rotated like ham.decode()
+    raw: (n, height, width) uint16 as received from sensor
+    counters, averages: (n, ) uint16
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as f:
+            self.header = read_header(f)
+        self.width = self.header["width"]
+        self.height = self.header["height"]
+        dtype = record_dtype(self.width, self.height)
+        # Ignore a partially written last record
+        n = (os.path.getsize(fn) - HEADER_SZ) // dtype.itemsize
+        if n:
+            records = np.memmap(fn,
+                                dtype=dtype,
+                                mode="r",
+                                offset=HEADER_SZ,
+                                shape=(n, ))
+            self.raw = records["img"]
+            self.counters = records["counter"]
+            self.averages = records["average"]
+        else:
+            self.raw = np.zeros((0, self.height, self.width), dtype="<u2")
+            self.counters = np.zeros((0, ), dtype="<u2")
+            self.averages = np.zeros((0, ), dtype="<u2")
+        self.frames = self.raw[:, ::-1, ::-1]
+
+    def __len__(self):
+        return len(self.raw)
+
+    def decode(self, i):
+        """Return frame i as a PIL image, same as ham.decode()"""
+        return ham.decode(self.raw[i].tobytes(), self.width, self.height)
+
+
+def open_burst(din):
+    """Return Burst for capture dir din, or None if it doesn't have one"""
+    fn = os.path.join(din, BURST_FN)
+    if not os.path.exists(fn):
+        return None
+    return Burst(fn)
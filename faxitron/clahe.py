@@ -0,0 +1,112 @@
+"""
+Contrast limited adaptive histogram equalization (CLAHE) on uint16 arrays
+
+Image is split into tiles, each gets a clipped histogram equalization LUT
+and pixels are bilinearly blended between the LUTs of the 4 nearest tiles
+Similar to skimage.exposure.equalize_adapthist but without float conversion
+"""
+
+import concurrent.futures
+import numpy as np
+import os
+
+
+def tile_shape(shape, tile=None):
+    """
+    tile: None for 1/8 of the image, int for square tiles or (height, width)
+    """
+    height, width = shape
+    if not tile:
+        tile = (max(height // 8, 1), max(width // 8, 1))
+    elif isinstance(tile, int):
+        tile = (tile, tile)
+    return min(tile[0], height), min(tile[1], width)
+
+
+def tile_luts(binned, tileh, tilew, nbins, clip_limit, executor):
+    """Return (tiles y, tiles x, nbins) LUTs from a padded, binned image"""
+    tiles_y = binned.shape[0] // tileh
+    tiles_x = binned.shape[1] // tilew
+    tile_pixels = tileh * tilew
+    clim = max(int(clip_limit * tile_pixels), 1) if clip_limit else None
+
+    def row_luts(ty):
+        band = binned[ty * tileh:(ty + 1) * tileh]
+        # Histogram of every tile in the band with one bincount
+        tile_x = np.arange(band.shape[1]) // tilew
+        index = tile_x[None, :] * nbins + band
+        hists = np.bincount(index.ravel(),
+                            minlength=tiles_x * nbins).reshape(tiles_x, nbins)
+        if clim:
+            excess = np.sum(np.maximum(hists - clim, 0), axis=1)
+            np.minimum(hists, clim, out=hists)
+            # Spread clipped counts over all bins
+            hists += (excess // nbins)[:, None]
+            remain = excess % nbins
+            hists += np.arange(nbins)[None, :] < remain[:, None]
+        cdfs = np.cumsum(hists, axis=1)
+        return cdfs * (0xFFFF / cdfs[:, -1:])
+
+    return np.array(list(executor.map(row_luts, range(tiles_y))),
+                    dtype=np.float32)
+
+
+def axis_weights(n, tile, ntiles):
+    """
+    Per pixel: lower tile index, upper tile index, upper tile weight
+    Tile centers are the interpolation points, edges clamp to nearest tile
+    """
+    pos = (np.arange(n) + 0.5) / tile - 0.5
+    lo = np.floor(pos).astype(np.intp)
+    weight = (pos - lo).astype(np.float32)
+    hi = np.clip(lo + 1, 0, ntiles - 1)
+    lo = np.clip(lo, 0, ntiles - 1)
+    return lo, hi, weight
+
+
+def clahe(npim, clip_limit=0.01, tile=None, nbins=4096, workers=None):
+    """
+    Return CLAHE equalized uint16 copy of 2D npim
+
+    clip_limit: fraction of a tile's pixels any histogram bin may hold (0: no clipping)
+    tile: see tile_shape()
+    nbins: histogram bins across the 16 bit range (power of 2)
+    workers: threads, default one per core
+    """
+    npim = np.asarray(npim)
+    assert npim.ndim == 2, npim.shape
+    assert nbins & (nbins - 1) == 0 and nbins <= 0x10000, nbins
+    height, width = npim.shape
+    tileh, tilew = tile_shape(npim.shape, tile)
+    tiles_y = -(-height // tileh)
+    tiles_x = -(-width // tilew)
+
+    shift = 16 - int(nbins).bit_length() + 1
+    binned = np.right_shift(np.clip(npim, 0, 0xFFFF).astype(np.uint16),
+                            shift).astype(np.intp)
+    # Pad partial tiles by reflection so they have a full histogram
+    padded = np.pad(binned, ((0, tiles_y * tileh - height),
+                             (0, tiles_x * tilew - width)),
+                    mode="reflect" if min(height, width) > 1 else "edge")
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or os.cpu_count()) as executor:
+        luts = tile_luts(padded, tileh, tilew, nbins, clip_limit, executor)
+
+        y0, y1, wy = axis_weights(height, tileh, tiles_y)
+        x0, x1, wx = axis_weights(width, tilew, tiles_x)
+        ret = np.empty((height, width), dtype=np.uint16)
+
+        def blend_rows(ty):
+            rows = slice(ty * tileh, min((ty + 1) * tileh, height))
+            b = binned[rows]
+            ya = y0[rows, None]
+            yb = y1[rows, None]
+            top = luts[ya, x0, b] * (1 - wx) + luts[ya, x1, b] * wx
+            bot = luts[yb, x0, b] * (1 - wx) + luts[yb, x1, b] * wx
+            wyr = wy[rows, None]
+            val = top * (1 - wyr) + bot * wyr
+            ret[rows] = np.round(val)
+
+        list(executor.map(blend_rows, range(tiles_y)))
+    return ret
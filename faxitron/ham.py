@@ -2,14 +2,18 @@
 
 import binascii
 import datetime
+import json
 import time
 import usb1
 from faxitron.util import hexdump, add_bool_arg, tobytes, tostr
 from faxitron import util
 from PIL import Image
+import numpy as np
 import os
+import queue
 import struct
 import sys
+import threading
 
 HAM_VID = 0x0661
 # C9730DK-11
@@ -308,6 +312,106 @@ def ham_init(dev, exp_ms=500):
     return width_ret, height_ret
 
 
+def info_cache_fn(sn):
+    return os.path.join(os.path.expanduser("~"), ".cache", "faxitron",
+                        "ham_%s.json" % sn)
+
+
+def info_cache_load(sn, info1_raw):
+    """Return cached (width, height) if info1 still matches, otherwise None"""
+    fn = info_cache_fn(sn)
+    try:
+        with open(fn, "r") as f:
+            j = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if j.get("info1") != binascii.hexlify(info1_raw).decode("ascii"):
+        return None
+    return j["width"], j["height"]
+
+
+def info_cache_save(sn, info1_raw, width, height):
+    fn = info_cache_fn(sn)
+    try:
+        util.mkdir_p(os.path.dirname(fn))
+        util.json_write(
+            fn, {
+                "info1": binascii.hexlify(info1_raw).decode("ascii"),
+                "width": width,
+                "height": height,
+            })
+    except IOError as e:
+        print("WARNING: failed to write %s: %s" % (fn, e))
+
+
+def ham_init_fast(dev, exp_ms=1000, use_cache=True):
+    """
+    Reach the same sensor state as ham_init() with fewer round trips
+
+    Sends the same configuration commands as ham_init() in the same order
+    since it's unknown which of them change sensor state
+    Skips the repeated info1 / exposure reads and the intermediate exposure
+    and trigger settings
+    info2 is cached per serial number
+    ROI is checked once at the end instead of after each command
+    Raises on mismatch, see Hamamatsu for falling back to ham_init()
+    """
+    validate_cmd1(dev, 0x00, "\x01", msg="open")
+    info1_raw = get_info1_raw(dev)
+    _vendor, _model, _ver, sn = parse_info1(info1_raw)
+    wh = use_cache and info_cache_load(sn, info1_raw)
+    if wh:
+        width, height = wh
+    else:
+        width, height = get_info2(dev)
+        use_cache and info_cache_save(sn, info1_raw, width, height)
+
+    validate_cmd1(dev,
+                  0x24,
+                  b"\x00\x00\x00\x06\x00\x00\x00\x20\x00\x00\x00\x03",
+                  msg="0x24")
+    for cmd in (0x2A, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x4A, 0x4F):
+        validate_cmd1(dev, cmd, b"\x00", msg="0x%02X" % cmd)
+    validate_cmd1(dev, 0x23, b"\x01", msg="0x23")
+    validate_cmd1(dev, 0x29, b"\x00", msg="0x29")
+
+    set_roi_wh(dev, width, height)
+    # Mode writes, same order as the pcap since their meaning is unknown
+    for mode in (0x02, 0x12, 0x18):
+        validate_cmd1(dev,
+                      0x2E,
+                      b"\x00",
+                      msg="mode 0x%02X" % mode,
+                      payload=struct.pack(">I", mode))
+    for i, expect in enumerate((
+            b"\x3F\x9E\xB8\x51\xEB\x85\x1E\xB8",
+            b"\x40\x34\x00\x00\x00\x00\x00\x00",
+            b"\x3F\x50\x62\x4D\xD2\xF1\xA9\xFC",
+            b"\x00\x00\x00\x00\x00\x00\x00\x00",
+    )):
+        validate_cmd1(dev,
+                      0x21,
+                      expect,
+                      msg="0x21 %u" % i,
+                      payload=struct.pack(">I", i))
+    for mode in (0x12, 0x02):
+        validate_cmd1(dev,
+                      0x2E,
+                      b"\x00",
+                      msg="mode 0x%02X" % mode,
+                      payload=struct.pack(">I", mode))
+    set_exp(dev, exp_ms)
+    trig_int(dev)
+
+    # One verification round
+    # Exposure isn't read back: set_exp() ack is the only reliable check
+    roi = get_roi_wh(dev)
+    if roi != (width, height):
+        raise Exception("fast init: ROI %s, expected %s" % (roi,
+                                                            (width, height)))
+    return width, height
+
+
 def check_sync(buff, verbose=False):
     syncpos = 0
     n = 0
@@ -352,7 +456,7 @@ def sync2str(word):
     }.get(word, "MSG_%04X" % word)
 
 
-# TODO: make this thread capable to always take images and suck off as needed
+# See Hamamatsu.cap_stream() to always take images and suck off as needed
 #STATE_BEGIN = 'BEGIN'
 #STATE_END = 'END'
 class CapImgN:
@@ -363,6 +467,7 @@ class CapImgN:
                  height,
                  depth=2,
                  n=1,
+                 nbuffs=None,
                  verbose=0):
         self.dev = dev
         self.usbcontext = usbcontext
@@ -420,7 +525,10 @@ class CapImgN:
         self.urb_size = 0x4000
 
         # len(self.rawbuff) < imgx_sz and len(self.messages) < 1
+        # View into the pool buffer currently being filled
         self.rawbuff = None
+        # Number of bytes written into rawbuff
+        self.rawpos = 0
         self.urb_max = 31
 
         # for debugging
@@ -432,8 +540,32 @@ class CapImgN:
         self.imgx_sz = self.imgsz + 2
         self.lens = []
 
+        # Preallocated frame buffers, recycled round robin
+        # A frame returned by run() stays valid until nbuffs more frames are captured
+        # Default to one per requested image so nothing is ever overwritten
+        if nbuffs is None:
+            nbuffs = n
+        assert nbuffs >= 1
+        # Leave room for a full URB overshooting the end of frame
+        self.buff_sz = self.imgx_sz + self.urb_size
+        self.pool = [
+            memoryview(bytearray(self.buff_sz)) for _i in range(nbuffs)
+        ]
+        self.pooli = 0
+
+    def next_buff(self):
+        """
+        Buffer to capture into
+        Only advances once a frame is yielded so failed attempts reuse it
+        """
+        return self.pool[self.pooli]
+
+    def frame_done(self):
+        self.pooli = (self.pooli + 1) % len(self.pool)
+
     def process_end(self, endbuff):
-        self.verbose and print("rawbuff: %u bytes" % len(self.rawbuff))
+        self.verbose and print("rawbuff: %u bytes" % self.rawpos)
+        assert self.rawpos >= self.imgx_sz, (self.rawpos, self.imgx_sz)
         buff = self.rawbuff[0:self.imgx_sz]
         self.verbose and print("buff: %u bytes" % len(buff))
         rawimg = buff[0:self.imgsz]
@@ -442,19 +574,19 @@ class CapImgN:
         self.verbose and print("footer: %u bytes" % len(footer))
 
         if self.verbose:
-            hexdump(buff[self.widthd * 0:self.widthd * 0 + 16], "First row")
-            hexdump(buff[self.widthd * 1:self.widthd * 1 + 16], "Second row")
+            hexdump(bytes(buff[self.widthd * 0:self.widthd * 0 + 16]),
+                    "First row")
+            hexdump(bytes(buff[self.widthd * 1:self.widthd * 1 + 16]),
+                    "Second row")
             hexdump(
-                buff[self.widthd * (self.width - 1):self.widthd *
-                     (self.width - 1) + 16], "Last row")
-            hexdump(buff[-16:], "Last bytes")
-            hexdump(footer, "Image footer")
+                bytes(buff[self.widthd * (self.width - 1):self.widthd *
+                           (self.width - 1) + 16]), "Last row")
+            hexdump(bytes(buff[-16:]), "Last bytes")
+            hexdump(bytes(footer), "Image footer")
             #hexdump(rawbuff, "Additional bytes")
-            print("Additional bytes: %u" % len(self.rawbuff))
-            assert len(
-                self.rawbuff
-            ) == self.imgx_sz, "%u bytes, overshot by %u bytes" % (len(
-                self.rawbuff), len(self.rawbuff) - self.imgx_sz)
+            print("Additional bytes: %u" % self.rawpos)
+            assert self.rawpos == self.imgx_sz, "%u bytes, overshot by %u bytes" % (
+                self.rawpos, self.rawpos - self.imgx_sz)
             # very slow
             # check_sync(self.rawbuff)
 
@@ -492,10 +624,12 @@ class CapImgN:
                 return
 
             # f you API. Why would anyone want uninitialized memory?
-            buff = trans.getBuffer()[:trans.getActualLength()]
+            # View only, data is copied once into the frame buffer below
+            buff = memoryview(
+                trans.getBuffer()).cast('B')[:trans.getActualLength()]
             sync = is_sync(buff, verbose=self.verbose)
             if sync:
-                net_bytes = 0 if self.rawbuff is None else len(self.rawbuff)
+                net_bytes = 0 if self.rawbuff is None else self.rawpos
                 # Don't warn after recovering from error
                 if not (self.rawbuff is None and sync == MSG_BEGIN):
                     print(
@@ -511,18 +645,20 @@ class CapImgN:
                     self.urb_remain += 1
                     return
 
-                assert len(self.rawbuff) < self.imgx_sz, len(self.rawbuff)
-                assert not sync, ("0x%04X" % sync, len(self.rawbuff))
+                assert self.rawpos < self.imgx_sz, self.rawpos
+                assert not sync, ("0x%04X" % sync, self.rawpos)
                 self.lens.append(len(buff))
 
-                self.rawbuff.extend(buff)
+                pos = self.rawpos + len(buff)
+                assert pos <= self.buff_sz, (pos, self.buff_sz)
+                self.rawbuff[self.rawpos:pos] = buff
+                self.rawpos = pos
 
-                est_submit = len(
-                    self.rawbuff) + self.urb_size * self.urb_remain
+                est_submit = self.rawpos + self.urb_size * self.urb_remain
                 est_remain = self.imgx_sz - est_submit
 
                 if est_remain > 0:
-                    assert len(self.rawbuff) < self.imgx_sz
+                    assert self.rawpos < self.imgx_sz
                     self.urb_remain += 1
                     trans.submit()
         except:
@@ -552,7 +688,8 @@ class CapImgN:
             self.urb_remain += 1
 
     def run_cap(self):
-        self.rawbuff = bytearray()
+        self.rawbuff = self.next_buff()
+        self.rawpos = 0
         self.packets = 0
 
         self.trans_l = []
@@ -573,7 +710,7 @@ class CapImgN:
             trans.close()
 
         self.verbose and print("%u packets, %u bytes" %
-                               (self.packets, len(self.rawbuff)))
+                               (self.packets, self.rawpos))
         assert self.running
 
     """
@@ -589,9 +726,21 @@ class CapImgN:
     Is there a chance I'm going too quick between init and cap?
     """
 
+    def abort(self):
+        """Stop the sensor streaming frames"""
+        abort_stream(self.dev)
+
+        tabort = time.time()
+        while time.time() - tabort < 1.0:
+            buff = self.dev.bulkRead(0x82, 512, timeout=2500)
+            if is_sync(buff, verbose=self.verbose) == MSG_ABORTED:
+                return
+        raise Exception("Failed to get abort")
+
     # TODO: reconsider error handling on bad messages
     def run(self, timeout_ms=2500):
         self.timeout_ms = timeout_ms
+        aborted = False
         try:
             self.tstart = time.time()
             for imgi in range(self.n):
@@ -626,7 +775,12 @@ class CapImgN:
                         # Abort capture for higher level logic to restart
                         self.running = False
                         break
+                    # Frame is now owned by the consumer
+                    self.frame_done()
+                    tyield = time.time()
                     yield res
+                    # Don't count time the consumer held us against the timeout
+                    self.tstart += time.time() - tyield
                     self.rawbuff = None
                     break
             if self.running:
@@ -634,17 +788,17 @@ class CapImgN:
                 sync = is_sync(buff, verbose=self.verbose)
                 assert sync == MSG_BEGIN, sync2str(sync)
 
-            abort_stream(self.dev)
-
-            tabort = time.time()
-            while time.time() - tabort < 1.0:
-                buff = self.dev.bulkRead(0x82, 512, timeout=2500)
-                if is_sync(buff, verbose=self.verbose) == MSG_ABORTED:
-                    break
-            else:
-                raise Exception("Failed to get abort")
+            aborted = True
+            self.abort()
         finally:
             self.running = False
+            # ex: consumer closed us early or capture failed
+            # Otherwise the sensor keeps streaming
+            if not aborted:
+                try:
+                    self.abort()
+                except Exception as e:
+                    print("WARNING: failed to abort stream: %s" % e)
 
 
 def cap_imgn(dev,
@@ -653,6 +807,7 @@ def cap_imgn(dev,
              height,
              depth=2,
              n=1,
+             nbuffs=None,
              timeout_ms=2500,
              verbose=0):
     cap = CapImgN(dev,
@@ -661,16 +816,20 @@ def cap_imgn(dev,
                   height,
                   depth=depth,
                   n=n,
+                  nbuffs=nbuffs,
                   verbose=verbose)
+    frames = cap.run(timeout_ms=timeout_ms)
     try:
-        for v in cap.run(timeout_ms=timeout_ms):
+        for v in frames:
             yield v
     finally:
         cap.running = False
+        # Abort the stream now rather than whenever frames is collected
+        frames.close()
 
 
-def decode(buff, width, height, depth=2):
-    '''Given bin return PIL image object'''
+def decode_slow(buff, width, height, depth=2):
+    '''Given bin return PIL image object. Reference per pixel implementation'''
     buff = bytearray(buff)
     assert len(buff) == width * height * depth
 
@@ -687,6 +846,22 @@ def decode(buff, width, height, depth=2):
     return img.rotate(180)
 
 
+def decode_np(buff, width, height, depth=2):
+    '''Given bin return 2D uint16 numpy view (no copy) in display orientation'''
+    assert depth == 2
+    assert len(buff) == width * height * depth
+    npim = np.frombuffer(buff, dtype='<u2').reshape(height, width)
+    # 2023-06-24: rotate to more accurately reflect being in front of DX-50
+    return npim[::-1, ::-1]
+
+
+def decode(buff, width, height, depth=2):
+    '''Given bin return PIL image object'''
+    npim = decode_np(buff, width, height, depth=depth)
+    # Single bulk copy into the 32 bit "I" layout decode_slow() produces
+    return Image.fromarray(npim.astype(np.int32))
+
+
 def trig_n(dev, n):
     validate_cmd1(dev,
                   0x2D,
@@ -753,7 +928,13 @@ High level API object
 
 
 class Hamamatsu:
-    def __init__(self, exp_ms=1000, init=True, verbose=False):
+    """
+    fast_init: use ham_init_fast(), falling back to ham_init() if it fails
+    Default from environment variable FAXITRON_FAST_INIT (0/1)
+    """
+    def __init__(self, exp_ms=1000, init=True, fast_init=None, verbose=False):
+        if fast_init is None:
+            fast_init = os.getenv("FAXITRON_FAST_INIT", "0") == "1"
         self.usbcontext = usb1.USBContext()
         self.dev = open_dev(self.usbcontext)
         self.dev.claimInterface(0)
@@ -764,10 +945,33 @@ class Hamamatsu:
         self.height = None
         self.depth = 2
         if init:
-            self.width, self.height = ham_init(self.dev, exp_ms=self.exp_ms)
+            self.width, self.height = self.init(fast=fast_init)
         self.verbose = verbose
 
-    def cap(self, cb, n=1):
+    def init(self, fast=False):
+        """Return (width, height)"""
+        if fast:
+            try:
+                return ham_init_fast(self.dev, exp_ms=self.exp_ms)
+            except Exception as e:
+                print("WARNING: fast init failed, doing full init: %s" % e)
+                self.dev.resetDevice()
+        return ham_init(self.dev, exp_ms=self.exp_ms)
+
+    def close(self):
+        if self.dev:
+            self.dev.releaseInterface(0)
+            self.dev.close()
+            self.dev = None
+            self.usbcontext.close()
+
+    def cap_iter(self, n=1, nbuffs=None):
+        """
+        Yield (i, counter, rawimg, average) as frames arrive
+        Re-triggers until n good frames have been collected
+        rawimg is a view into a CapImgN buffer pool, see nbuffs
+        """
+
         #time.sleep(3)
 
         def setup():
@@ -783,36 +987,105 @@ class Hamamatsu:
             width, height = get_roi_wh(dev)
             force_trig(dev)
 
-        raws = []
         self.verbose and print("Collecting")
         """
         timeout
         Give allocation for one corrupt image...ocassionally happens at begin
         """
+        capi = 0
         trigi = 0
         while True:
-            to_cap = n - len(raws)
+            to_cap = n - capi
             if to_cap <= 0:
                 break
             print("Trig %u, to_cap %u" % (trigi, to_cap))
             setup()
-            for _counter, rawimg, _average in cap_imgn(
-                    self.dev,
-                    self.usbcontext,
-                    self.width,
-                    self.height,
-                    self.depth,
-                    timeout_ms=((to_cap + 1) * (self.exp_ms + 250) + 1000),
-                    n=to_cap,
-                    verbose=self.verbose):
-                print("Captured img %u" % len(raws))
-                raws.append(rawimg)
+            frames = cap_imgn(self.dev,
+                              self.usbcontext,
+                              self.width,
+                              self.height,
+                              self.depth,
+                              timeout_ms=((to_cap + 1) * (self.exp_ms + 250) +
+                                          1000),
+                              n=to_cap,
+                              nbuffs=nbuffs,
+                              verbose=self.verbose)
+            try:
+                for counter, rawimg, average in frames:
+                    print("Captured img %u" % capi)
+                    yield capi, counter, rawimg, average
+                    capi += 1
+            finally:
+                frames.close()
             trigi += 1
-        self.verbose and print("Dispatching %u" % n)
-        for i in range(n):
+
+    def cap_stream(self, n=1, qdepth=4):
+        """
+        Capture from a background thread that keeps the USB events serviced
+        Yields (i, counter, rawimg, average) as frames arrive
+
+        At most qdepth frames are queued, so memory use doesn't depend on n
+        rawimg is only valid until the next frame is pulled: copy it to keep it
+        Don't otherwise use the device until the stream is exhausted or closed
+        """
+        frames = queue.Queue(maxsize=qdepth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def acquire():
+            # One buffer being filled, one held by the consumer
+            frames_in = self.cap_iter(n=n, nbuffs=qdepth + 2)
+            try:
+                for v in frames_in:
+                    put(v)
+                    if stop.is_set():
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                # On early stop this aborts the sensor stream
+                frames_in.close()
+
+        thread = threading.Thread(target=acquire, name="ham_cap")
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                v = frames.get()
+                if v is None:
+                    break
+                if isinstance(v, Exception):
+                    raise v
+                yield v
+        finally:
+            stop.set()
+            thread.join()
+
+    def cap(self, cb, n=1, stream=False, qdepth=4, meta=False):
+        """
+        Call cb(i, rawimg) for n images
+        stream: call cb as frames arrive instead of after all are captured
+        meta: call cb(i, rawimg, counter, average) instead
+        """
+        if stream:
+            frames = self.cap_stream(n=n, qdepth=qdepth)
+        else:
+            frames = list(self.cap_iter(n=n))
+            self.verbose and print("Dispatching %u" % n)
+        for i, counter, rawimg, average in frames:
             self.verbose and print("img %u" % i)
-            raw = raws[i]
-            cb(i, raw)
+            if meta:
+                cb(i, rawimg, counter, average)
+            else:
+                cb(i, rawimg)
         # self.verbose and print("exp: %u" % get_exp(self.dev))
 
     def set_exp(self, ms):
@@ -0,0 +1,267 @@
+"""
+Keep the sensor open and initialized between captures
+
+HamDaemon owns a Hamamatsu and serves capture requests over a Unix socket
+so repeat captures skip USB enumeration, reset and ham_init
+HamClient is a drop in replacement for the parts of Hamamatsu that the
+capture scripts use
+
+Protocol: one JSON object per line
+Requests: {"cmd": "info"}, {"cmd": "cap", "n": N, "exp_ms": X},
+{"cmd": "reset"}, {"cmd": "quit"}
+Every reply is a JSON line, {"error": msg} on failure
+A capture replies with {"n": N}, then per frame {"i", "counter", "average"}
+followed by the raw frame bytes, then {"done": true, "time": sec}
+"""
+
+from faxitron import ham
+from faxitron import util
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import time
+
+DEFAULT_SOCK = os.path.join(tempfile.gettempdir(), "faxitron_ham.sock")
+
+
+def send_msg(f, j):
+    f.write((json.dumps(j) + "\n").encode("ascii"))
+
+
+class HamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+            except ValueError:
+                send_msg(self.wfile, {"error": "bad request"})
+                continue
+            try:
+                self.server.dispatch(req, self.wfile)
+            except (BrokenPipeError, ConnectionResetError):
+                print("WARNING: client went away")
+                # Sensor may be mid capture
+                self.server.drop_sensor()
+                return
+            except Exception as e:
+                print("WARNING: %s failed: %s" % (req.get("cmd"), e))
+                # Don't trust the sensor state after a failure
+                self.server.drop_sensor()
+                send_msg(self.wfile, {"error": str(e)})
+            if self.server.quit:
+                return
+
+
+class HamDaemon(socketserver.UnixStreamServer):
+    """
+    Serves one client at a time, which also serializes access to the sensor
+    The sensor is opened on the first request and reopened after an error
+    """
+    def __init__(self,
+                 sock_fn=DEFAULT_SOCK,
+                 exp_ms=1000,
+                 fast_init=None,
+                 verbose=False):
+        if os.path.exists(sock_fn):
+            if ping(sock_fn):
+                raise Exception("daemon already running on %s" % sock_fn)
+            # Left over from a daemon that didn't shut down cleanly
+            os.unlink(sock_fn)
+        socketserver.UnixStreamServer.__init__(self, sock_fn, HamHandler)
+        self.sock_fn = sock_fn
+        self.exp_ms = exp_ms
+        self.fast_init = fast_init
+        self.verbose = verbose
+        self.h = None
+        self.quit = False
+        self.caps = 0
+
+    def sensor(self):
+        if self.h is None:
+            tstart = time.time()
+            self.h = ham.Hamamatsu(exp_ms=self.exp_ms,
+                                   fast_init=self.fast_init,
+                                   verbose=self.verbose)
+            self.h.set_exp(self.exp_ms)
+            print("Sensor init: %0.3f sec" % (time.time() - tstart, ))
+        return self.h
+
+    def drop_sensor(self):
+        if self.h:
+            try:
+                self.h.close()
+            except Exception as e:
+                print("WARNING: sensor close failed: %s" % e)
+        self.h = None
+
+    def dispatch(self, req, f):
+        cmd = req.get("cmd")
+        if cmd == "info":
+            send_msg(f, self.sensor().get_json())
+        elif cmd == "cap":
+            self.cap(f, req["n"], req.get("exp_ms", self.exp_ms))
+        elif cmd == "reset":
+            self.drop_sensor()
+            send_msg(f, {"ok": True})
+        elif cmd == "quit":
+            self.quit = True
+            send_msg(f, {"ok": True})
+        else:
+            raise Exception("unknown command %s" % cmd)
+
+    def cap(self, f, n, exp_ms):
+        h = self.sensor()
+        # Sensor keeps its exposure between requests
+        if exp_ms != h.exp_ms:
+            print("Setting exposure %u ms" % exp_ms)
+            h.set_exp(exp_ms)
+        imgsz = h.width * h.height * h.depth
+        tstart = time.time()
+        send_msg(f, {"n": n})
+        for i, counter, rawimg, average in h.cap_stream(n=n):
+            assert len(rawimg) == imgsz, (len(rawimg), imgsz)
+            send_msg(f, {"i": i, "counter": counter, "average": average})
+            f.write(rawimg)
+        dt = time.time() - tstart
+        self.caps += 1
+        print("Capture %u: %u frames in %0.3f sec" % (self.caps, n, dt))
+        send_msg(f, {"done": True, "time": dt})
+
+    def run(self):
+        print("Listening on %s" % self.sock_fn)
+        try:
+            while not self.quit:
+                self.handle_request()
+        finally:
+            self.drop_sensor()
+            self.server_close()
+            os.unlink(self.sock_fn)
+
+
+class HamClient:
+    """
+    Capture through a HamDaemon
+    Exposure set with set_exp() is sent along with each capture request
+    """
+    def __init__(self, sock_fn=DEFAULT_SOCK, exp_ms=1000, verbose=False):
+        self.sock_fn = sock_fn
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sock_fn)
+        self.f = self.sock.makefile("rwb")
+        self.exp_ms = exp_ms
+        self.verbose = verbose
+
+        self.info = self.request({"cmd": "info"})
+        self.width = self.info["width"]
+        self.height = self.info["height"]
+        self.depth = 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.sock:
+            self.f.close()
+            self.sock.close()
+            self.sock = None
+
+    def send(self, req):
+        send_msg(self.f, req)
+        self.f.flush()
+
+    def recv(self):
+        line = self.f.readline()
+        if not line:
+            raise Exception("daemon closed connection")
+        j = json.loads(line)
+        if "error" in j:
+            raise Exception("daemon: %s" % j["error"])
+        return j
+
+    def request(self, req):
+        self.send(req)
+        return self.recv()
+
+    def cap(self, cb, n=1, stream=False, qdepth=4, meta=False):
+        """Same as Hamamatsu.cap(), qdepth is ignored"""
+        imgsz = self.width * self.height * self.depth
+        self.send({"cmd": "cap", "n": n, "exp_ms": self.exp_ms})
+        self.recv()
+        frames = []
+        for _i in range(n):
+            j = self.recv()
+            rawimg = self.f.read(imgsz)
+            if len(rawimg) != imgsz:
+                raise Exception("daemon closed connection")
+            frame = (j["i"], j["counter"], rawimg, j["average"])
+            if stream:
+                self.dispatch(cb, frame, meta)
+            else:
+                frames.append(frame)
+        j = self.recv()
+        self.verbose and print("Daemon capture: %0.3f sec" % j["time"])
+        for frame in frames:
+            self.dispatch(cb, frame, meta)
+
+    def dispatch(self, cb, frame, meta):
+        i, counter, rawimg, average = frame
+        self.verbose and print("img %u" % i)
+        if meta:
+            cb(i, rawimg, counter, average)
+        else:
+            cb(i, rawimg)
+
+    def set_exp(self, ms):
+        self.exp_ms = ms
+
+    def decode(self, buff):
+        return ham.decode(buff, self.width, self.height)
+
+    def get_json(self):
+        ret = dict(self.info)
+        ret["exp_ms"] = self.exp_ms
+        return ret
+
+    def write_json(self, outdir):
+        util.json_write(os.path.join(outdir, "sensor.json"), self.get_json())
+
+
+def ping(sock_fn=DEFAULT_SOCK):
+    """Return True if a daemon is answering on sock_fn"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sock_fn)
+        return True
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        s.close()
+
+
+def command(sock_fn, cmd):
+    """Send a control command (reset, quit) without touching the sensor"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(sock_fn)
+    with s, s.makefile("rwb") as f:
+        send_msg(f, {"cmd": cmd})
+        f.flush()
+        j = json.loads(f.readline())
+    if "error" in j:
+        raise Exception("daemon: %s" % j["error"])
+    return j
+
+
+def open_sensor(daemon=None, exp_ms=1000, verbose=False):
+    """
+    Return a HamClient if daemon (socket file name) is given
+    Otherwise open the sensor directly
+    """
+    if daemon:
+        print("Using sensor daemon %s" % daemon)
+        return HamClient(daemon, exp_ms=exp_ms, verbose=verbose)
+    return ham.Hamamatsu(exp_ms=exp_ms, verbose=verbose)
@@ -1,9 +1,14 @@
+from faxitron import ham
+from faxitron import burst
+from faxitron import util
 import numpy as np
 from PIL import Image
 import glob
 import os
 import json
 import statistics
+import subprocess
+import warnings
 
 
 def parse_roi(s):
@@ -12,15 +17,51 @@ def parse_roi(s):
     return [int(x) for x in s.split(',')]
 
 
-def histeq_im(im, nbr_bins=256):
-    imnp2 = np.array(im)
-    imnp2_eq = histeq_np(imnp2, nbr_bins=nbr_bins)
-    imf = Image.fromarray(imnp2_eq)
-    return imf.convert("I")
+def histeq_im(im, nbins=0x10000):
+    return npi2im(histeq_lut(np.array(im), nbins=nbins))
+
+
+def as_hist_index(npim, nbins=0x10000):
+    '''Integer pixel values usable as histogram / LUT index'''
+    npim = np.asarray(npim)
+    if npim.dtype.kind == 'f':
+        npim = np.round(npim)
+    if npim.dtype not in (np.uint8, np.uint16) or nbins < 0x10000:
+        npim = np.clip(npim, 0, nbins - 1).astype(np.intp)
+    return npim
+
+
+def hist16(npim, nbins=0x10000):
+    '''Exact histogram with one bin per integer pixel value'''
+    return np.bincount(as_hist_index(npim, nbins=nbins).ravel(),
+                       minlength=nbins)
+
+
+def histeq_lut_create(ref, nbins=0x10000):
+    '''
+    Return histogram equalization LUT computed from ref
+    ref: full image or ROI. nbins: 0x4000 is enough for raw sensor data (PIX_MAX)
+    Pixel values not in ref map according to where they fall in ref's distribution
+    '''
+    cdf = np.cumsum(hist16(ref, nbins=nbins))
+    return np.round(0xFFFF * (cdf / cdf[-1])).astype(np.uint16)
+
+
+def histeq_lut_apply(npim, lut):
+    '''Apply LUT to an image or stack of images (any shape). Returns uint16'''
+    return lut[as_hist_index(npim, nbins=len(lut))]
+
+
+def histeq_lut(npim, ref=None, nbins=0x10000):
+    '''Histogram equalize npim, optionally using ref (ex: ROI) for the histogram'''
+    if ref is None:
+        ref = npim
+    return histeq_lut_apply(npim, histeq_lut_create(ref, nbins=nbins))
 
 
 def histeq_np(npim, nbr_bins=256):
     '''
+    Legacy interpolated version of histeq_lut()
     Given a numpy nD array (ie image), return a histogram equalized numpy nD array of pixels
     That is, return 2D if given 2D, or 1D if 1D
     '''
@@ -54,6 +95,62 @@ def histeq_np_apply(npim, create):
     return ret1d.reshape(npim.shape)
 
 
+def histeq_magick(npim):
+    '''
+    ImageMagick style -equalize of a uint16 array
+    Full 16 bit histogram, darkest value => 0, brightest => 0xFFFF
+    '''
+    cdf = np.cumsum(hist16(npim))
+    black = cdf[0]
+    white = cdf[-1]
+    # ImageMagick leaves the image alone if it can't be stretched
+    if white == black:
+        return np.array(npim, dtype=np.uint16)
+    lut = np.round(0xFFFF * (cdf - black) / (white - black)).astype(np.uint16)
+    return lut[npim]
+
+
+def histeq_convert(npim):
+    '''
+    In process version of:
+    convert in.png \\( +clone -equalize \\) -average out.png
+    ie average of the original and equalized uint16 array
+    '''
+    npim = np.asarray(npim, dtype=np.uint16)
+    ret = histeq_magick(npim).astype(np.uint32)
+    ret += npim
+    # Round half up
+    ret += 1
+    ret //= 2
+    return ret.astype(np.uint16)
+
+
+def histeq_convert_ext(npim):
+    '''histeq_convert() using the ImageMagick convert command'''
+    with util.AutoTempFN(suffix='.png') as tmpa:
+        with util.AutoTempFN(suffix='.png') as tmpb:
+            npi2im(npim).save(tmpa)
+            subprocess.check_call(
+                "convert %s \\( +clone -equalize \\) -average %s" %
+                (tmpa, tmpb),
+                shell=True)
+            return np.array(Image.open(tmpb), dtype=np.uint16)
+
+
+def np_inv16(npim, out=None):
+    '''
+    Invert 16 bit pixels of a numpy array
+    Result keeps the input dtype. Pass out=npim to invert in place
+    '''
+    return np.subtract(0xFFFF, npim, out=out, dtype=npim.dtype)
+
+
+def im_inv16(im):
+    '''Invert 16 bit image pixels'''
+    # ImageOps.invert(): IOError("not supported for this image mode")
+    return Image.fromarray(np_inv16(np.array(im)))
+
+
 # Tried misc other things but this was only thing I could make work
 def im_inv16_slow(im):
     '''Invert 16 bit image pixels'''
@@ -65,7 +162,8 @@ def im_inv16_slow(im):
     return ret
 
 
-def npf2im(statef):
+def npf2im_slow(statef):
+    '''Reference per pixel implementation of npf2im()'''
     #return statef, None
     rounded = np.round(statef)
     #print("row1: %s" % rounded[1])
@@ -89,32 +187,159 @@ def npf2im(statef):
     return im
 
 
-def average_imgs(imgs, scalar=None):
-    width, height = imgs[0].size
-    if not scalar:
-        scalar = 1.0
-    scalar = scalar / len(imgs)
+def npf2u16(statef):
+    '''Round a float array to uint16, same as npf2im_slow()'''
+    return np.array(np.round(statef), dtype=np.uint16)
 
-    statef = np.zeros((height, width), float)
-    for im in imgs:
-        assert (width, height) == im.size
-        statef = statef + scalar * np.array(im, dtype=float)
 
+def npf2im(statef):
+    '''Round a 2D float array to a 16 bit value "I" image'''
+    # fromarray() with mode="I" reinterprets uint16 data rather than converting
+    # Widen first so the buffer really is 32 bit
+    return Image.fromarray(npf2u16(statef).astype(np.int32))
+
+
+class FrameAccumulator:
+    '''
+    Running statistics over a sequence of same sized frames
+    Frames are summed in place so they don't need to be kept around
+
+    var: track variance (Welford's online algorithm)
+    minmax: track per pixel min / max
+    '''
+    def __init__(self, var=True, minmax=True):
+        self.track_var = var
+        self.track_minmax = minmax
+        self.n = 0
+        self.shape = None
+        self.sum = None
+        # Welford running mean and sum of squared differences
+        self.wmean = None
+        self.m2 = None
+        self.fmin = None
+        self.fmax = None
+        # scratch buffers for the current frame
+        self.buff = None
+        self.tmp = None
+
+    def add(self, im):
+        '''Add a 2D numpy array or PIL image'''
+        if isinstance(im, Image.Image):
+            im = np.asarray(im)
+        if self.sum is None:
+            self.shape = im.shape
+            self.sum = np.zeros(im.shape, dtype=np.float64)
+            self.buff = np.empty(im.shape, dtype=np.float64)
+            if self.track_var:
+                self.wmean = np.zeros(im.shape, dtype=np.float64)
+                self.m2 = np.zeros(im.shape, dtype=np.float64)
+                self.tmp = np.empty(im.shape, dtype=np.float64)
+            if self.track_minmax:
+                self.fmin = np.array(im, dtype=np.float64)
+                self.fmax = np.array(im, dtype=np.float64)
+        assert im.shape == self.shape, (im.shape, self.shape)
+        self.n += 1
+
+        # Integer pixel sums are exact in float64 for any reasonable n
+        np.copyto(self.buff, im, casting='unsafe')
+        np.add(self.sum, self.buff, out=self.sum)
+        if self.track_minmax:
+            np.minimum(self.fmin, self.buff, out=self.fmin)
+            np.maximum(self.fmax, self.buff, out=self.fmax)
+        if self.track_var:
+            # delta = x - mean
+            np.subtract(self.buff, self.wmean, out=self.buff)
+            # m2 += delta * (x - new mean) = delta^2 * (n - 1) / n
+            np.multiply(self.buff, self.buff, out=self.tmp)
+            self.tmp *= (self.n - 1) / self.n
+            np.add(self.m2, self.tmp, out=self.m2)
+            # mean += delta / n
+            self.buff *= 1.0 / self.n
+            np.add(self.wmean, self.buff, out=self.wmean)
+
+    def add_raw(self, buff, width, height):
+        '''Add a raw sensor frame, ex: from Hamamatsu.cap() callback'''
+        self.add(ham.decode_np(buff, width, height))
+
+    def mean(self, scalar=None):
+        assert self.n
+        if not scalar:
+            scalar = 1.0
+        return self.sum * (scalar / self.n)
+
+    def var(self):
+        '''Population variance per pixel'''
+        assert self.n and self.track_var
+        return self.m2 / self.n
+
+    def rms(self):
+        '''RMS deviation from the mean per pixel'''
+        return np.sqrt(self.var())
+
+    def min(self):
+        assert self.track_minmax
+        return self.fmin
+
+    def max(self):
+        assert self.track_minmax
+        return self.fmax
+
+
+def npi2im(npim):
+    '''Integer 2D array (ex: uint16) to "I" image'''
+    return Image.fromarray(np.asarray(npim, dtype=np.int32))
+
+
+def average_imgs(imgs, scalar=None):
+    acc = FrameAccumulator(var=False, minmax=False)
+    for im in imgs:
+        acc.add(im)
+    statef = acc.mean(scalar=scalar)
     return statef, npf2im(statef)
 
 
-def average_dir(din, images=0, verbose=1, scalar=None):
-    imgs = []
+def average_burst(bst, images=0, verbose=1, scalar=None):
+    '''Return average of a burst.Burst as a 2D float array'''
+    frames = bst.frames
+    verbose and print('Reading %s w/ %u images' % (bst.fn, len(frames)))
+    if images and len(frames) > images:
+        verbose and print("WARNING: only using first %u images" % images)
+        frames = frames[0:images]
+    assert len(frames)
+    if not scalar:
+        scalar = 1.0
+    # Reduce straight over the memmap, same as FrameAccumulator.mean()
+    statef = np.sum(frames, axis=0, dtype=np.float64)
+    statef *= scalar / len(frames)
+    return statef
+
+
+def average_dir_np(din, images=0, verbose=1, scalar=None):
+    '''Return average of a capture dir as a 2D float array'''
+    # Prefer single file burst over decoding .png's
+    bst = burst.open_burst(din)
+    if bst is not None and len(bst):
+        return average_burst(bst,
+                             images=images,
+                             verbose=verbose,
+                             scalar=scalar)
 
     files = list(glob.glob(os.path.join(din, "cap_*.png")))
     verbose and print('Reading %s w/ %u images' % (din, len(files)))
 
+    acc = FrameAccumulator(var=False, minmax=False)
     for fni, fn in enumerate(files):
-        imgs.append(Image.open(fn))
+        with Image.open(fn) as im:
+            acc.add(im)
         if images and fni + 1 >= images:
             verbose and print("WARNING: only using first %u images" % images)
             break
-    return average_imgs(imgs, scalar=scalar)
+    return acc.mean(scalar=scalar)
+
+
+def average_dir(din, images=0, verbose=1, scalar=None):
+    statef = average_dir_np(din, images=images, verbose=verbose, scalar=scalar)
+    return statef, npf2im(statef)
 
 
 def default_cal_dir(j=None, im_dir=None):
@@ -161,7 +386,8 @@ def im_med3(im, x, y, badimg):
     return int(statistics.median(pixs))
 
 
-def do_bpr(im, badimg):
+def do_bpr_slow(im, badimg):
+    '''Reference per pixel implementation of do_bpr()'''
     ret = im.copy()
     bad_pixels = make_bpm(badimg)
     for x, y in bad_pixels:
@@ -169,27 +395,248 @@ def do_bpr(im, badimg):
     return ret
 
 
+class BadPixelMap:
+    '''
+    bad.png compiled into index arrays for vectorized bad pixel replacement
+    Each bad pixel is replaced with the median of its good 3x3 neighbors
+    '''
+    def __init__(self, badimg):
+        self.width, self.height = badimg.size
+        badnp = np.array(badimg, dtype=bool)
+        ys, xs = np.nonzero(badnp)
+        # Flat indices of bad pixels
+        self.bad = ys * self.width + xs
+
+        dxs = []
+        dys = []
+        for dx in range(-1, 2, 1):
+            for dy in range(-1, 2, 1):
+                if dx or dy:
+                    dxs.append(dx)
+                    dys.append(dy)
+        # (bad pixels, 8) neighbor coordinates
+        nxs = xs[:, None] + np.array(dxs)
+        nys = ys[:, None] + np.array(dys)
+        inbounds = (nxs >= 0) & (nxs < self.width) & (nys >= 0) & (
+            nys < self.height)
+        nxs = np.clip(nxs, 0, self.width - 1)
+        nys = np.clip(nys, 0, self.height - 1)
+        # Padding entries point at a valid index but are masked off
+        self.neighbors = nys * self.width + nxs
+        self.valid = inbounds & ~badnp[nys, nxs]
+
+    def __len__(self):
+        return len(self.bad)
+
+    def to_arrays(self, prefix="bpm_"):
+        return {
+            prefix + "wh": np.array([self.width, self.height]),
+            prefix + "bad": self.bad,
+            prefix + "neighbors": self.neighbors,
+            prefix + "valid": self.valid,
+        }
+
+    @staticmethod
+    def from_arrays(arrays, prefix="bpm_"):
+        '''Inverse of to_arrays()'''
+        ret = BadPixelMap.__new__(BadPixelMap)
+        ret.width, ret.height = [int(x) for x in arrays[prefix + "wh"]]
+        ret.bad = arrays[prefix + "bad"]
+        ret.neighbors = arrays[prefix + "neighbors"]
+        ret.valid = arrays[prefix + "valid"]
+        return ret
+
+    def apply(self, npim):
+        '''
+        Return a copy of npim with bad pixels replaced
+        npim: (height, width) frame or (n, height, width) stack
+        '''
+        shape = npim.shape
+        assert shape[-2:] == (self.height, self.width), (shape, self.width,
+                                                         self.height)
+        flat = np.reshape(npim, (-1, self.height * self.width))
+        ret = np.array(flat)
+
+        vals = flat[:, self.neighbors].astype(np.float64)
+        vals[:, ~self.valid] = np.nan
+        with warnings.catch_warnings():
+            # All-NaN slice: no good neighbors, handled below
+            warnings.simplefilter("ignore", RuntimeWarning)
+            meds = np.nanmedian(vals, axis=2)
+        nomed = np.isnan(meds)
+        if np.any(nomed):
+            print("WARNING: %u bad pixels without good neighbors" %
+                  np.count_nonzero(np.any(nomed, axis=0)))
+        # Truncate like int(statistics.median())
+        ret[:, self.bad] = np.where(nomed, flat[:, self.bad], np.trunc(meds))
+        return ret.reshape(shape)
+
+    def apply_im(self, im):
+        return Image.fromarray(self.apply(np.array(im)))
+
+
+CAL_CACHE_FN = "cal.npz"
+
+
+def cal_sources(cal_dir):
+    '''Signature of the calibration images, used to invalidate compiled calibration'''
+    ret = []
+    for basename in ("ff.png", "df.png", "bad.png"):
+        fn = os.path.join(cal_dir, basename)
+        if os.path.exists(fn):
+            st = os.stat(fn)
+            ret.append([basename, st.st_mtime_ns, st.st_size])
+    return ret
+
+
+class Calibration:
+    '''
+    ff.png / df.png / bad.png for one sensor (see default_cal_dir()) compiled
+    into offset / gain arrays and a BadPixelMap
+    Use load_cal() to get one
+    '''
+    def __init__(self, cal_dir):
+        self.cal_dir = cal_dir
+        # ex: c9730dk-11_5403219
+        self.sensor = os.path.basename(os.path.normpath(cal_dir))
+        self.sources = cal_sources(cal_dir)
+        # Subtract, then multiply to stretch df => 0, ff => 0xFFFF
+        self.offset = None
+        self.gain = None
+        self.bpm = None
+
+    def compile(self):
+        ffn = os.path.join(self.cal_dir, 'ff.png')
+        dfn = os.path.join(self.cal_dir, 'df.png')
+        if os.path.exists(ffn) and os.path.exists(dfn):
+            np_ff2 = np.array(Image.open(ffn))
+            np_df2 = np.array(Image.open(dfn))
+
+            # ff *should* be brighter than df
+            # (due to .png pixel value inversion convention)
+            mins = np.minimum(np_df2, np_ff2)
+            maxs = np.maximum(np_df2, np_ff2)
+
+            cal_det = maxs - mins
+            # Prevent div 0 on bad pixels
+            cal_det = np.maximum(cal_det, 1)
+            self.offset = mins
+            self.gain = 0xFFFF / cal_det
+
+        badfn = os.path.join(self.cal_dir, 'bad.png')
+        if os.path.exists(badfn):
+            with Image.open(badfn) as badimg:
+                self.bpm = BadPixelMap(badimg)
+
+    def save(self, fn):
+        arrays = {
+            "sensor": np.array(self.sensor),
+            "sources": np.array(json.dumps(self.sources)),
+        }
+        if self.offset is not None:
+            arrays["offset"] = self.offset
+            arrays["gain"] = self.gain
+        if self.bpm:
+            arrays.update(self.bpm.to_arrays())
+        # Other processes may be reading it
+        tmp = "%s.%u.tmp" % (fn, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, fn)
+
+    def load(self, fn):
+        '''Load compiled calibration. Return False if stale'''
+        with np.load(fn) as arrays:
+            if json.loads(str(arrays["sources"])) != self.sources:
+                return False
+            if "offset" in arrays:
+                self.offset = arrays["offset"]
+                self.gain = arrays["gain"]
+            if "bpm_bad" in arrays:
+                self.bpm = BadPixelMap.from_arrays(arrays)
+        return True
+
+    def rescale(self, wip):
+        '''Stretch uint16 array so df => 0 and ff => 0xFFFF'''
+        assert self.gain is not None, "Missing ff.png / df.png"
+        np_scaled = np.subtract(wip, self.offset, dtype=np.float64)
+        np_scaled *= self.gain
+        # If it clipped, squish to good values
+        np.clip(np_scaled, 0x0000, 0xFFFF, out=np_scaled)
+        # Historically went through a PIL "F" image: float32 then truncate
+        return np_scaled.astype(np.float32).astype(np.uint16)
+
+
+_cal_cache = {}
+
+
+def load_cal(cal_dir, verbose=True):
+    '''
+    Get Calibration for cal_dir
+    Reuses the in memory or on disk (cal.npz) compiled version unless the images changed
+    '''
+    key = os.path.abspath(cal_dir)
+    sources = cal_sources(cal_dir)
+    cached = _cal_cache.get(key)
+    if cached and cached.sources == sources:
+        return cached
+
+    cal = Calibration(cal_dir)
+    fn = os.path.join(cal_dir, CAL_CACHE_FN)
+    loaded = False
+    if os.path.exists(fn):
+        try:
+            loaded = cal.load(fn)
+        except (OSError, ValueError, KeyError) as e:
+            print("WARNING: failed to load %s: %s" % (fn, e))
+    if not loaded:
+        verbose and print("Compiling calibration %s" % cal_dir)
+        cal.compile()
+        try:
+            cal.save(fn)
+        except OSError as e:
+            print("WARNING: failed to save %s: %s" % (fn, e))
+    _cal_cache[key] = cal
+    return cal
+
+
+def load_bpm(cal_dir):
+    '''Get compiled bad pixel map for a calibration dir, see load_cal()'''
+    bpm = load_cal(cal_dir).bpm
+    assert bpm is not None, "Missing %s" % os.path.join(cal_dir, 'bad.png')
+    return bpm
+
+
+def do_bpr(im, badimg):
+    '''badimg: bad.png image or BadPixelMap'''
+    if not isinstance(badimg, BadPixelMap):
+        badimg = BadPixelMap(badimg)
+    return badimg.apply_im(im)
+
+
 def dir2np(din, cal_dir=None, bpr=False):
     ret = []
 
-    badimg = None
+    bpm = None
     if bpr and cal_dir:
-        badimg = Image.open(os.path.join(cal_dir, 'bad.png'))
+        bpm = load_bpm(cal_dir)
         print("Loaded bad pixel map")
 
     m = 0
     while True:
         burst = []
         for fn in list(glob.glob(os.path.join(din, "cap_%02u_*.png" % m))):
-            im = Image.open(fn)
-            if badimg:
-                im = do_bpr(im, badimg)
-
-            npim = np.array(im, dtype=float)
-            burst.append(np.ndarray.flatten(npim))
+            with Image.open(fn) as im:
+                npim = np.array(im)
+            burst.append(npim)
         if not burst:
             break
-        ret.append(burst)
+        burst = np.array(burst)
+        if bpm:
+            # Whole burst in one go
+            burst = bpm.apply(burst)
+        burst = burst.astype(float)
+        ret.append(list(burst.reshape(len(burst), -1)))
         m += 1
     return ret
 
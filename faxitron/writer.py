@@ -0,0 +1,146 @@
+"""
+Decode and save captured frames, optionally on a worker pool
+so that PNG compression overlaps with the next exposure
+"""
+
+from faxitron import ham
+import concurrent.futures
+import os
+import time
+
+STAGES = ("decode", "png", "bin", "burst")
+
+
+def write_frame(buff, width, height, pngfn=None, binfn=None):
+    """
+    Save one raw frame
+    Top level so it can run in a worker process
+    Returns seconds spent per stage
+    """
+    ret = {}
+    if binfn:
+        tstart = time.time()
+        with open(binfn, 'wb') as f:
+            f.write(buff)
+        ret["bin"] = time.time() - tstart
+    if pngfn:
+        tstart = time.time()
+        img = ham.decode(buff, width, height)
+        ret["decode"] = time.time() - tstart
+        tstart = time.time()
+        img.save(pngfn)
+        ret["png"] = time.time() - tstart
+    return ret
+
+
+class FrameWriter:
+    """
+    Capture callback (ie for Hamamatsu.cap) that writes <prefix>NN.png / .bin
+
+    writers: 0 to write on the calling thread, otherwise pool size
+    processes: use a process pool instead of a thread pool
+    burst: burst.BurstWriter to also append raw frames to (use cap(meta=True))
+    close() must be called to wait for all files to be written
+    """
+    def __init__(self,
+                 outdir,
+                 width,
+                 height,
+                 prefix="cap_",
+                 bin_out=False,
+                 png_out=True,
+                 writers=0,
+                 processes=False,
+                 burst=None):
+        self.outdir = outdir
+        self.width = width
+        self.height = height
+        self.prefix = prefix
+        self.bin_out = bin_out
+        self.png_out = png_out
+        self.writers = writers
+        self.burst = burst
+
+        self.pool = None
+        if writers:
+            if processes:
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=writers)
+            else:
+                self.pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=writers)
+        self.pending = []
+        self.frames = 0
+        # Time the capture thread spent in the callback
+        self.cb_time = 0.0
+        self.stage_times = dict([(stage, 0.0) for stage in STAGES])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def fns(self, n):
+        binfn = os.path.join(self.outdir, "%s%02u.bin" % (self.prefix, n))
+        pngfn = os.path.join(self.outdir, "%s%02u.png" % (self.prefix, n))
+        return (pngfn if self.png_out else None,
+                binfn if self.bin_out else None)
+
+    def add_times(self, times):
+        for k, v in times.items():
+            self.stage_times[k] += v
+
+    def reap(self, block_until=None):
+        """Collect finished writes. Wait until at most block_until remain"""
+        while self.pending:
+            if block_until is not None and len(self.pending) > block_until:
+                self.add_times(self.pending.pop(0).result())
+            elif self.pending[0].done():
+                self.add_times(self.pending.pop(0).result())
+            else:
+                break
+
+    def __call__(self, n, buff, counter=0, average=0):
+        tstart = time.time()
+        if self.burst:
+            # Cheap and must stay in frame order, so do it here
+            self.burst.add(buff, counter=counter, average=average)
+            self.stage_times["burst"] += time.time() - tstart
+        pngfn, binfn = self.fns(n)
+        pngfn and print("Saving %s" % pngfn)
+        binfn and print("Saving %s" % binfn)
+        if self.pool is None:
+            self.add_times(
+                write_frame(buff, self.width, self.height, pngfn, binfn))
+        else:
+            # Streaming capture reuses buff, so hand the pool its own copy
+            # Bound outstanding frames to keep memory flat
+            self.reap(block_until=2 * self.writers)
+            self.pending.append(
+                self.pool.submit(write_frame, bytes(buff), self.width,
+                                 self.height, pngfn, binfn))
+        self.frames += 1
+        self.cb_time += time.time() - tstart
+
+    def close(self):
+        """Wait for every file to be written and print timing summary"""
+        tstart = time.time()
+        try:
+            self.reap(block_until=0)
+        finally:
+            if self.pool:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+            if self.burst:
+                self.burst.close()
+        drain_time = time.time() - tstart
+
+        print("Writer: %u frames, %u writers" % (self.frames, self.writers))
+        print("  capture callback: %0.3f sec" % self.cb_time)
+        for stage in STAGES:
+            if self.stage_times[stage]:
+                print("  %s: %0.3f sec (%0.3f / frame)" %
+                      (stage, self.stage_times[stage],
+                       self.stage_times[stage] / max(self.frames, 1)))
+        print("  drain: %0.3f sec" % drain_time)
@@ -29,10 +29,81 @@ def default_port():
     return "/dev/ttyUSB0"
 
 
+def parse_device(ret):
+    # FIXME: MX-20 support
+    assert ret in ("DX-50", "MX-20"), ret
+    return ret
+
+
+def parse_revision(ret):
+    # Verify its a valid version
+    # ? why was this commented out
+    float(ret)
+    # But return as string to avoid precision issues
+    return ret
+
+
+def parse_state(ret):
+    assert ret in "WDR", ret
+    return ret
+
+
+def parse_mode(ret):
+    assert ret in "FR", ret
+    return ret
+
+
+def parse_kvp(ret):
+    ret = int(ret, 10)
+    assert 10 <= ret <= 35, ret
+    return ret
+
+
+def parse_timed(ret):
+    ret = int(ret, 10)
+    # FIXME: range?
+    assert 1 <= ret <= 9999, ret
+    return ret
+
+
+def match_reply(line, queries):
+    """Return the query line is a reply to, or None"""
+    for query in queries:
+        if line.startswith(query):
+            return query
+    return None
+
+
+# get_json() key, query, reply parser
+JSON_QUERIES = (
+    ("dev", "?D", parse_device),
+    ("rev", "?R", parse_revision),
+    ("mode", "?M", parse_mode),
+    ("state", "?S", parse_state),
+    ("timed", "?T", parse_timed),
+    ("kvp", "?V", parse_kvp),
+)
+
+
 # TODO: look into MX-20
 class XRay:
-    def __init__(self, port="/dev/ttyUSB0", ser_timeout=0.1, verbose=False):
+    """
+    Settings confirmed by a query are cached for cache_ttl seconds
+    Setting a cached value again is skipped
+    Cached settings are only used while the unit is known to be in remote mode
+    since the front panel can change them otherwise
+    Cache is dropped if the door is seen open or the unit warming up
+    cache_ttl: 0 to always query
+    """
+    def __init__(self,
+                 port="/dev/ttyUSB0",
+                 ser_timeout=0.1,
+                 cache_ttl=300.0,
+                 verbose=False):
         self.verbose = verbose
+        self.cache_ttl = cache_ttl
+        # key => (value, time confirmed)
+        self.cache = {}
         self.verbose and print("opening", port)
         self.serial = serial.Serial(
             port,
@@ -48,14 +119,77 @@ class XRay:
             writeTimeout=None)
         self.serial.flushInput()
         self.serial.flushOutput()
+        # Received bytes not yet returned by recv_nl() / recv_c()
+        self.rxbuf = bytearray()
+        self.tsend = None
+        self.reset_stats()
         # Abort current command, if any
         #self.send("A")
         self.flush()
 
+    def reset_stats(self):
+        self.stats = {
+            # Replies received and seconds from send to complete reply
+            "replies": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+            "latency_last": 0.0,
+            # Glitch bytes dropped
+            "bad_bytes": 0,
+            # Queries resent after getting no reply
+            "retries": 0,
+            # Sets and queries skipped thanks to cached state
+            "cache_hits": 0,
+        }
+
+    def latency_stats(self):
+        """
+        Return dict of response statistics
+        latency_mean / max / last in seconds
+        """
+        ret = dict(self.stats)
+        ret["latency_mean"] = self.stats["latency_total"] / max(
+            self.stats["replies"], 1)
+        return ret
+
+    def remember(self, key, value):
+        self.cache[key] = (value, time.time())
+        return value
+
+    def cached(self, key):
+        value, tconfirm = self.cache.get(key, (None, 0.0))
+        if value is None or time.time() - tconfirm >= self.cache_ttl:
+            return None
+        return value
+
+    def recall(self, key):
+        """
+        Return cached value if confirmed within cache_ttl, otherwise None
+        Settings other than mode also require remote mode to be cached
+        """
+        value = self.cached(key)
+        if value is None:
+            return None
+        if key != "mode" and self.cached("mode") != "R":
+            return None
+        self.stats["cache_hits"] += 1
+        return value
+
+    def invalidate(self):
+        """Forget cached settings, ex: front panel may have been used"""
+        self.cache = {}
+
+    def saw_state(self, state):
+        # Door open or warming up (power cycle?): settings may have changed
+        if state in "DW":
+            self.invalidate()
+        return state
+
     def flush(self):
         """
         Wait to see if there is anything in progress
         """
+        self.rxbuf = bytearray()
         timeout = self.serial.timeout
         try:
             self.serial.timeout = 0.1
@@ -66,28 +200,50 @@ class XRay:
         finally:
             self.serial.timeout = timeout
 
+    def fill(self, tstart, timeout):
+        """
+        Append everything the port has to rxbuf, waiting up to one
+        serial timeout for the first byte
+        """
+        buff = self.serial.read(max(self.serial.in_waiting, 1))
+        if not buff:
+            if timeout is not None and time.time() - tstart >= timeout:
+                raise Timeout('Timed out')
+            return
+        bad = buff.count(b'\xFF')
+        if bad:
+            print("WARNING: bad response 0xFF")
+            self.stats["bad_bytes"] += bad
+            buff = buff.replace(b'\xFF', b'')
+        self.verbose and print("XRAY DEBUG: read %s" % (buff, ))
+        self.rxbuf += buff
+
+    def replied(self, tsend):
+        dt = time.time() - tsend
+        self.stats["replies"] += 1
+        self.stats["latency_total"] += dt
+        self.stats["latency_max"] = max(self.stats["latency_max"], dt)
+        self.stats["latency_last"] = dt
+
+    def reply_done(self):
+        """Count latency of the command sent by send(), if any"""
+        if self.tsend is not None:
+            self.replied(self.tsend)
+            self.tsend = None
+
     def recv_nl(self, timeout=1.0):
         """
         Most but not all commands respond with a new line
         """
-        ret = ''
         tstart = time.time()
         while True:
-            c = self.serial.read(1)
-            if not c:
-                if timeout is not None and time.time() - tstart >= timeout:
-                    raise Timeout('Timed out')
-                continue
-            if c == b'\xFF':
-                print("WARNING: bad response 0xFF")
-                continue
-            c = c.decode("ascii")
-            self.verbose and print("%s %02X" % (c, ord(c)))
-            if c == '\r':
+            pos = self.rxbuf.find(b'\r')
+            if pos >= 0:
                 break
-            ret += c
-        else:
-            raise Timeout('Timed out waiting for closing ~')
+            self.fill(tstart, timeout)
+        ret = self.rxbuf[0:pos].decode("ascii")
+        del self.rxbuf[0:pos + 1]
+        self.reply_done()
 
         if self.verbose:
             print('XRAY DEBUG: recv: returning: "%s"' % (ret, ))
@@ -95,38 +251,136 @@ class XRay:
 
     def recv_c(self, timeout=1.0):
         tstart = time.time()
-        while True:
-            c = self.serial.read(1)
-            if not c:
-                if timeout is not None and time.time() - tstart >= timeout:
-                    raise Timeout('Timed out')
-                continue
-            else:
-                c = c.decode("ascii")
-                self.verbose and print('XRAY DEBUG: recv: returning: %s %02X' %
-                                       (c, ord(c)))
-                return c
+        while not self.rxbuf:
+            self.fill(tstart, timeout)
+        c = chr(self.rxbuf[0])
+        del self.rxbuf[0:1]
+        self.reply_done()
+        self.verbose and print('XRAY DEBUG: recv: returning: %s %02X' %
+                               (c, ord(c)))
+        return c
+
+    def write_cmd(self, out):
+        # \n seems to have no effect
+        self.serial.write((out + '\r').encode('ascii'))
+        self.serial.flush()
+        self.tsend = time.time()
 
     def send(self, out, recv=False):
         """
-        TODO: "The DX-50 will occasionally miss commands and queries, continue sending the string until the unit responds"
-        Maybe add some retry logic
+        "The DX-50 will occasionally miss commands and queries, continue sending the string until the unit responds"
+        recv: out is a query, return its reply (without echo). Retried if no reply
+        Commands (!) have no reply so callers verify them with a query
         """
 
         if self.verbose:
             print('XRAY DEBUG: sending: %s' % (out, ))
-            if self.serial.inWaiting():
-                raise Exception('At send %d chars waiting' %
-                                self.serial.inWaiting())
-        # \n seems to have no effect
-        self.serial.write((out + '\r').encode('ascii'))
-        self.serial.flush()
+            waiting = len(self.rxbuf) + self.serial.in_waiting
+            if waiting:
+                raise Exception('At send %d chars waiting' % waiting)
         if recv:
-            ret = self.recv_nl()
-            out_echo = ret[0:len(out)]
-            # print(out_echo, out)
-            assert out_echo == out
-            return ret[len(out):]
+            return self.query_batch([out])[out]
+        self.write_cmd(out)
+
+    def send_verified(self, out, get, expect, retries=2):
+        """
+        Send command out, which has no reply, until get() returns expect
+        Resent up to retries times in case the unit missed it
+        """
+        for tryi in range(retries + 1):
+            if tryi:
+                print("WARNING: %s not applied (got %s), retrying" %
+                      (out, got))
+                self.stats["retries"] += 1
+            self.send(out)
+            # No feedback, so query to verify set
+            got = get()
+            if got == expect:
+                return
+        assert got == expect, got
+
+    def query_batch(self, queries, timeout=1.0, retries=2):
+        """
+        Send queries back to back without waiting for each reply
+        Return dict of query => reply (without echo)
+
+        Replies are matched by their echoed query, so order doesn't matter
+        Queries still unanswered after timeout are resent up to retries times
+        A resent query may have only been slow and get answered twice
+        After a retry, wait for the extra replies so they aren't taken as
+        replies to a later query
+        """
+        ret = {}
+        pending = list(queries)
+        sends = {}
+        tfirst = {}
+        # query => replies still expected from resending it
+        extra = {}
+        # When the last extra reply should have arrived
+        tdrain = None
+        for tryi in range(retries + 1):
+            if tryi:
+                print("WARNING: no reply to %s, retrying" % " ".join(pending))
+                self.stats["retries"] += len(pending)
+            tsends = {}
+            for query in pending:
+                self.verbose and print('XRAY DEBUG: sending: %s' % (query, ))
+                self.write_cmd(query)
+                tsends[query] = self.tsend
+                tfirst.setdefault(query, self.tsend)
+                sends[query] = sends.get(query, 0) + 1
+            # Latency is tracked per query below
+            self.tsend = None
+            try:
+                while pending:
+                    line = self.recv_nl(timeout=timeout)
+                    if self.discard_extra(line, extra):
+                        continue
+                    query = match_reply(line, pending)
+                    if not query:
+                        print("WARNING: unexpected reply %s" % line)
+                        continue
+                    pending.remove(query)
+                    self.replied(tsends[query])
+                    ret[query] = line[len(query):]
+                    extra[query] = sends[query] - 1
+                    if extra[query]:
+                        # If this reply was to the first send, the reply to
+                        # the last one comes as much later as it was sent
+                        # Plus some slack for jitter
+                        delay = tsends[query] - tfirst[query]
+                        t = time.time() + delay + timeout / 4
+                        tdrain = max(tdrain or t, t)
+            except Timeout:
+                pass
+            if not pending:
+                break
+        else:
+            raise Timeout("No reply to %s" % " ".join(pending))
+
+        # If the first send was dropped this waits for nothing
+        # but later calls don't pay for it
+        try:
+            while any(extra.values()):
+                dt = tdrain - time.time()
+                if dt <= 0:
+                    break
+                line = self.recv_nl(timeout=dt)
+                if not self.discard_extra(line, extra):
+                    print("WARNING: unexpected reply %s" % line)
+        except Timeout:
+            pass
+        return ret
+
+    def discard_extra(self, line, extra):
+        """Return True if line is an expected duplicate reply in extra"""
+        query = match_reply(line, [q for q, n in extra.items() if n])
+        if not query:
+            return False
+        self.verbose and print(
+            "XRAY DEBUG: discarding duplicate reply %s" % line)
+        extra[query] -= 1
+        return True
 
     def get_device(self):
         """
@@ -135,10 +389,7 @@ class XRay:
         mcmaster: MX-20
         But other models like MX-20 should use the same API
         """
-        ret = self.send("?D", recv=True)
-        # FIXME: MX-20 support
-        assert ret in ("DX-50", "MX-20")
-        return ret
+        return parse_device(self.send("?D", recv=True))
 
     def get_revision(self):
         """
@@ -148,12 +399,7 @@ class XRay:
         Seltzman: 4.2
         Wonder what the differences are?
         """
-        vers = self.send("?R", recv=True)
-        # Verify its a valid version
-        # ? why was this commented out
-        float(vers)
-        # But return as string to avoid precision issues
-        return vers
+        return parse_revision(self.send("?R", recv=True))
 
     def assert_ready(self):
         s = self.get_state()
@@ -173,9 +419,7 @@ class XRay:
         D: door open
         R: ready (door closed)
         """
-        ret = self.send("?S", recv=True)
-        assert ret in "WDR"
-        return ret
+        return self.saw_state(parse_state(self.send("?S", recv=True)))
 
     def get_mode(self):
         """
@@ -183,19 +427,16 @@ class XRay:
         F: front panel
         R: remote
         """
-        ret = self.send("?M", recv=True)
-        assert ret in "FR"
-        return ret
+        return self.remember("mode", parse_mode(self.send("?M", recv=True)))
 
     def mode_remote(self):
         """
         Set mode to remote
         """
-        self.send("!MR")
+        if self.recall("mode") == "R":
+            return
         # time.sleep(2.0)
-        # No feedback, so query to verify set
-        got = self.get_mode()
-        assert got == "R", got
+        self.send_verified("!MR", self.get_mode, "R")
 
     '''
     def mode_panel(self):
@@ -218,30 +459,23 @@ class XRay:
         NOTE: beep
         """
         assert 10 <= n <= 35
-        self.send("!V%u" % n)
-        # No feedback, so query to verify set
-        got = self.get_kvp()
-        assert got == n, got
+        if self.recall("kvp") == n:
+            return
+        self.send_verified("!V%u" % n, self.get_kvp, n)
 
     def get_kvp(self):
         """
         ?V    Get kV.
         Reply ?V26
     """
-        ret = self.send("?V", recv=True)
-        ret = int(ret, 10)
-        assert 10 <= ret <= 35
-        return ret
+        return self.remember("kvp", parse_kvp(self.send("?V", recv=True)))
 
     def get_timed(self):
         """
         Return exposure time in deciseconds
         """
-        ret = self.send("?T", recv=True)
-        ret = int(ret, 10)
-        # FIXME: range?
-        assert 1 <= ret <= 9999
-        return ret
+        ret = parse_timed(self.send("?T", recv=True))
+        return self.remember("timed", ret)
 
     def get_time(self):
         """
@@ -257,8 +491,9 @@ class XRay:
         NOTE: beep
         """
         assert 1 <= dsec <= 9999
-        self.send("!T%04u" % dsec)
-        assert dsec == self.get_timed()
+        if self.recall("timed") == dsec:
+            return
+        self.send_verified("!T%04u" % dsec, self.get_timed, dsec)
 
     def set_time(self, sec):
         """
@@ -279,8 +514,10 @@ class XRay:
         TODO: add abort Lock based param?
         not needed for now
         """
+        # Door is always checked below, kVp only if stale
+        # Exposure time sets the timeout, so always confirm it
         fire_time = self.get_time()
-        kvp = self.get_kvp()
+        kvp = self.recall("kvp") or self.get_kvp()
         if timeout is None:
             timeout = fire_time + 1.0
         verbose = verbose or self.verbose
@@ -331,14 +568,14 @@ class XRay:
         self.send("A")
 
     def get_json(self):
-        return {
-            "dev": self.get_device(),
-            "rev": self.get_revision(),
-            "mode": self.get_mode(),
-            "state": self.get_state(),
-            "timed": self.get_timed(),
-            "kvp": self.get_kvp(),
-        }
+        """Snapshot of source state, queried in one batch"""
+        replies = self.query_batch([query for _k, query, _p in JSON_QUERIES])
+        ret = dict([(k, parse(replies[query]))
+                    for k, query, parse in JSON_QUERIES])
+        self.saw_state(ret["state"])
+        for k in ("mode", "timed", "kvp"):
+            self.remember(k, ret[k])
+        return ret
 
     def write_json(self, outdir):
         util.json_write(os.path.join(outdir, "source.json"), self.get_json())
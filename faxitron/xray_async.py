@@ -0,0 +1,341 @@
+"""
+asyncio driver for the X-ray controller, see xray.XRay for the blocking one
+
+Lets tube control and sensor capture share one event loop:
+
+    xr = await AsyncXRay.open(port)
+    await xr.set_kvp(35)
+    await xr.fire_while(lambda: ham_raw.run(...))
+
+Requires pyserial-asyncio
+"""
+
+from faxitron.xray import Timeout, DoorOpen, WarmingUp, JSON_QUERIES
+from faxitron.xray import parse_device, parse_revision, parse_state
+from faxitron.xray import parse_mode, parse_kvp, parse_timed
+from faxitron.xray import default_port
+import asyncio
+import serial
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+# Sent during a fire sequence without a trailing \r
+FIRE_EVENTS = "XPS"
+
+
+class XRayProtocol(asyncio.Protocol):
+    """
+    Frames bytes from the controller
+    Query replies start with the echoed query and end with \\r
+    Fire sequence replies (X, P, S) are a single character
+    Lines go to the oldest matching query, characters to every subscriber
+    """
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.transport = None
+        self.rxbuf = bytearray()
+        # query => list of futures waiting for its reply
+        self.waiters = {}
+        self.subscribers = []
+        self.closed = None
+        self.bad_bytes = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_lost(self, exc):
+        for futures in self.waiters.values():
+            for future in futures:
+                future.done() or future.set_exception(
+                    exc or Exception("X-ray port closed"))
+        self.waiters = {}
+        self.closed.done() or self.closed.set_result(exc)
+
+    def data_received(self, data):
+        bad = data.count(b'\xFF')
+        if bad:
+            print("WARNING: bad response 0xFF")
+            self.bad_bytes += bad
+            data = data.replace(b'\xFF', b'')
+        self.verbose and print("XRAY DEBUG: read %s" % (data, ))
+        self.rxbuf += data
+        while self.rxbuf:
+            if self.rxbuf[0:1] == b'?':
+                pos = self.rxbuf.find(b'\r')
+                if pos < 0:
+                    return
+                line = self.rxbuf[0:pos].decode("ascii")
+                del self.rxbuf[0:pos + 1]
+                self.line_received(line)
+            else:
+                c = chr(self.rxbuf[0])
+                del self.rxbuf[0:1]
+                if c in "\r\n":
+                    continue
+                self.event_received(c)
+
+    def line_received(self, line):
+        for query, futures in self.waiters.items():
+            if line.startswith(query) and futures:
+                futures.pop(0).set_result(line[len(query):])
+                return
+        print("WARNING: unexpected reply %s" % line)
+
+    def event_received(self, c):
+        if c not in FIRE_EVENTS:
+            print("WARNING: unexpected char %s" % c)
+            return
+        for q in self.subscribers:
+            q.put_nowait(c)
+
+    def wait_reply(self, query):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(query, []).append(future)
+        return future
+
+    def cancel_reply(self, query, future):
+        futures = self.waiters.get(query, [])
+        if future in futures:
+            futures.remove(future)
+
+    def subscribe(self):
+        q = asyncio.Queue()
+        self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        self.subscribers.remove(q)
+
+
+class AsyncXRay:
+    """
+    Create with AsyncXRay.open()
+    Same API as xray.XRay, but coroutines
+    """
+    def __init__(self, transport, protocol, verbose=False):
+        self.transport = transport
+        self.protocol = protocol
+        self.verbose = verbose
+        # No state polling during the fire sequence
+        self.firing = False
+
+    @classmethod
+    async def open(cls, port=None, verbose=False):
+        if serial_asyncio is None:
+            raise Exception("AsyncXRay requires pyserial-asyncio")
+        transport, protocol = await serial_asyncio.create_serial_connection(
+            asyncio.get_running_loop(),
+            lambda: XRayProtocol(verbose=verbose),
+            port or default_port(),
+            baudrate=9600,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            rtscts=False,
+            dsrdtr=False,
+            xonxoff=False)
+        return cls(transport, protocol, verbose=verbose)
+
+    def close(self):
+        self.transport.close()
+
+    def send(self, out):
+        self.verbose and print('XRAY DEBUG: sending: %s' % (out, ))
+        self.transport.write((out + '\r').encode('ascii'))
+
+    async def query_batch(self, queries, timeout=1.0, retries=2):
+        """
+        Send queries back to back, return dict of query => reply (without echo)
+        Queries without a reply after timeout are resent up to retries times
+        """
+        ret = {}
+        pending = list(queries)
+        for tryi in range(retries + 1):
+            if tryi:
+                print("WARNING: no reply to %s, retrying" % " ".join(pending))
+            futures = {}
+            for query in pending:
+                futures[query] = self.protocol.wait_reply(query)
+                self.send(query)
+            await asyncio.wait(futures.values(), timeout=timeout)
+            for query, future in futures.items():
+                if future.done():
+                    ret[query] = future.result()
+                    pending.remove(query)
+                else:
+                    future.cancel()
+                    self.protocol.cancel_reply(query, future)
+            if not pending:
+                return ret
+        raise Timeout("No reply to %s" % " ".join(pending))
+
+    async def query(self, query, timeout=1.0, retries=2):
+        ret = await self.query_batch([query], timeout=timeout, retries=retries)
+        return ret[query]
+
+    async def get_device(self):
+        return parse_device(await self.query("?D"))
+
+    async def get_revision(self):
+        return parse_revision(await self.query("?R"))
+
+    async def get_state(self):
+        return parse_state(await self.query("?S"))
+
+    async def get_mode(self):
+        return parse_mode(await self.query("?M"))
+
+    async def get_kvp(self):
+        return parse_kvp(await self.query("?V"))
+
+    async def get_timed(self):
+        return parse_timed(await self.query("?T"))
+
+    async def get_time(self):
+        return await self.get_timed() / 10.0
+
+    async def get_json(self):
+        replies = await self.query_batch(
+            [query for _k, query, _p in JSON_QUERIES])
+        return dict([(k, parse(replies[query]))
+                     for k, query, parse in JSON_QUERIES])
+
+    async def assert_ready(self):
+        s = await self.get_state()
+        if s == 'D':
+            raise DoorOpen()
+        elif s == 'W':
+            raise WarmingUp()
+        assert s == 'R', s
+
+    async def send_verified(self, out, get, expect, retries=2):
+        """Send command out until await get() returns expect"""
+        for tryi in range(retries + 1):
+            if tryi:
+                print("WARNING: %s not applied (got %s), retrying" %
+                      (out, got))
+            self.send(out)
+            # No feedback, so query to verify set
+            got = await get()
+            if got == expect:
+                return
+        assert got == expect, got
+
+    async def mode_remote(self):
+        await self.send_verified("!MR", self.get_mode, "R")
+
+    async def set_kvp(self, n):
+        """n: 10 - 35"""
+        assert 10 <= n <= 35
+        await self.send_verified("!V%u" % n, self.get_kvp, n)
+
+    async def set_timed(self, dsec):
+        """dsec: deciseconds (ie 10 => 1.0 sec)"""
+        assert 1 <= dsec <= 9999
+        await self.send_verified("!T%04u" % dsec, self.get_timed, dsec)
+
+    async def set_time(self, sec):
+        await self.set_timed(round(sec * 10.0))
+
+    async def wait_event(self, q, expect, timeout):
+        try:
+            c = await asyncio.wait_for(q.get(), timeout)
+        except asyncio.TimeoutError:
+            raise Timeout("Timed out waiting for %s" % expect)
+        assert c == expect, "Got '%s'" % c
+
+    async def fire_begin(self, verbose=False):
+        """
+        NOTE: radiation emission
+        Return once the tube is on. Aborts and raises on failure
+        """
+        verbose = verbose or self.verbose
+        fire_time = await self.get_time()
+        kvp = await self.get_kvp()
+        # Sanity check the door to avoid timeout below if possible
+        await self.assert_ready()
+
+        q = self.protocol.subscribe()
+        self.firing = True
+        try:
+            verbose and print("fire: starting, %0.1f s @ %s kVp" %
+                              (fire_time, kvp))
+            self.send("!B")
+            await self.wait_event(q, "X", 1.0)
+            verbose and print("fire: confirming")
+            self.send("C")
+            await self.wait_event(q, "P", 1.0)
+        except BaseException:
+            self.fire_abort(verbose=verbose)
+            raise
+        finally:
+            self.protocol.unsubscribe(q)
+        return fire_time
+
+    async def fire(self, timeout=None, verbose=False):
+        """Fire and wait for the exposure to complete"""
+        verbose = verbose or self.verbose
+        # Subscribe before the tube turns on so S can't be missed
+        q = self.protocol.subscribe()
+        try:
+            fire_time = await self.fire_begin(verbose=verbose)
+            # Already checked by fire_begin()
+            assert await q.get() == "X"
+            assert await q.get() == "P"
+            try:
+                verbose and print("fire: waiting")
+                await self.wait_event(
+                    q, "S", fire_time + 1.0 if timeout is None else timeout)
+                self.firing = False
+                # Sanity check the door in case it was opened to interrupt the x-ray
+                await self.assert_ready()
+            except BaseException:
+                self.fire_abort(verbose=verbose)
+                raise
+        finally:
+            self.protocol.unsubscribe(q)
+        verbose and print("fire: done")
+
+    def fire_abort(self, verbose=False):
+        (verbose or self.verbose) and print("fire: aborting")
+        self.firing = False
+        self.send("A")
+
+    async def fire_while(self, fn, *args, verbose=False):
+        """
+        Turn the tube on, run blocking fn(*args) in an executor, then abort
+        ex: sensor capture
+        Return fn's return value
+        """
+        await self.fire_begin(verbose=verbose)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, fn, *args)
+        finally:
+            self.fire_abort(verbose=verbose)
+
+    async def states(self, poll=0.5):
+        """
+        Async iterator over state changes
+        Yields W / D / R as the polled overall state changes
+        and X / P / S as the fire sequence progresses
+        """
+        q = self.protocol.subscribe()
+        last = None
+        try:
+            while True:
+                if not self.firing:
+                    state = await self.get_state()
+                    if state != last:
+                        last = state
+                        yield state
+                try:
+                    yield await asyncio.wait_for(q.get(), poll)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.protocol.unsubscribe(q)
@@ -0,0 +1,215 @@
+"""
+Software DX-50 / MX-20 controller on a pty, for testing without hardware
+
+Implements the subset of the serial protocol xray.py uses:
+queries ?D ?R ?S ?M ?V ?T reply with the echoed query, value and \\r
+commands !V !T !MR !MF have no reply
+!B replies X (nothing if the door is open), C replies P and S once the
+exposure time has passed, A aborts
+
+Timing: bytes take 10 bits each at baud, plus reply_delay before replying
+Faults: ff_rate chance of a 0xFF glitch byte before a reply
+drop_rate chance a command or query is ignored
+drop_once(cmd) to ignore the next cmd
+
+    emu = XRayEmulator(reply_delay=0.02)
+    emu.start()
+    xr = xray.XRay(port=emu.port)
+"""
+
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+
+class XRayEmulator:
+    def __init__(self,
+                 model="DX-50",
+                 rev="2.2",
+                 baud=9600,
+                 reply_delay=0.01,
+                 ff_rate=0.0,
+                 drop_rate=0.0,
+                 warmup=0.0,
+                 kvp=35,
+                 timed=30,
+                 seed=None,
+                 verbose=False):
+        """
+        baud: 0 for instant transfers
+        warmup: seconds to report W after start
+        kvp, timed: initial settings
+        """
+        self.model = model
+        self.rev = rev
+        self.char_time = 10.0 / baud if baud else 0.0
+        self.reply_delay = reply_delay
+        self.ff_rate = ff_rate
+        self.drop_rate = drop_rate
+        self.warmup = warmup
+        self.verbose = verbose
+        self.random = random.Random(seed)
+
+        self.kvp = kvp
+        self.timed = timed
+        self.mode = "F"
+        self.door_open = False
+        # Commands to ignore once each
+        self.drops = []
+        # None, "armed" (X sent) or "firing" (P sent)
+        self.fire_state = None
+        self.fire_end = None
+
+        # Counters for tests / benchmarks
+        self.stats = {
+            "commands": 0,
+            "dropped": 0,
+            "bad_bytes": 0,
+            "shots": 0,
+        }
+
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # Keep open so the pty survives clients closing it
+        self.slave = slave
+        self.rxbuf = b""
+        # (time, bytes) to write, in order
+        self.txq = []
+        # When the emulated wire is free in each direction
+        self.tx_free = 0.0
+        self.rx_free = 0.0
+        self.tstart = None
+        self.thread = None
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        self.tstart = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="xray_emu")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def drop_once(self, cmd):
+        self.drops.append(cmd)
+
+    def state(self):
+        if time.time() - self.tstart < self.warmup:
+            return "W"
+        if self.door_open:
+            return "D"
+        return "R"
+
+    def reply(self, now, s):
+        if self.ff_rate and self.random.random() < self.ff_rate:
+            self.stats["bad_bytes"] += 1
+            s = "\xFF" + s
+        buff = s.encode("latin1")
+        tsend = max(now + self.reply_delay, self.tx_free)
+        self.tx_free = tsend + len(buff) * self.char_time
+        self.txq.append((self.tx_free, buff))
+
+    def command(self, now, cmd):
+        self.stats["commands"] += 1
+        if cmd in self.drops:
+            self.drops.remove(cmd)
+            self.verbose and print("emu: dropped %s" % cmd)
+            self.stats["dropped"] += 1
+            return
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.verbose and print("emu: dropped %s" % cmd)
+            self.stats["dropped"] += 1
+            return
+        self.verbose and print("emu: %s" % cmd)
+        queries = {
+            "?D": lambda: self.model,
+            "?R": lambda: self.rev,
+            "?S": self.state,
+            "?M": lambda: self.mode,
+            "?V": lambda: "%u" % self.kvp,
+            "?T": lambda: "%04u" % self.timed,
+        }
+        if cmd in queries:
+            self.reply(now, cmd + queries[cmd]() + "\r")
+        elif cmd.startswith("!V"):
+            n = int(cmd[2:], 10)
+            if 10 <= n <= 35:
+                self.kvp = n
+        elif cmd.startswith("!T"):
+            n = int(cmd[2:], 10)
+            if 1 <= n <= 9999:
+                self.timed = n
+        elif cmd in ("!MR", "!MF"):
+            self.mode = cmd[2]
+        elif cmd == "!B":
+            # If the door is open, no response is given
+            if self.state() == "R" and self.fire_state is None:
+                self.fire_state = "armed"
+                self.reply(now, "X")
+        elif cmd == "C":
+            if self.fire_state == "armed":
+                self.fire_state = "firing"
+                self.stats["shots"] += 1
+                self.reply(now, "P")
+                self.fire_end = now + self.reply_delay + self.timed / 10.0
+        elif cmd == "A":
+            self.fire_state = None
+            self.fire_end = None
+        else:
+            print("WARNING: emu: unknown command %s" % cmd)
+
+    def poll(self, now):
+        if self.fire_end is not None and now >= self.fire_end:
+            self.fire_state = None
+            self.fire_end = None
+            self.reply(now, "S")
+        while self.txq and self.txq[0][0] <= now:
+            os.write(self.master, self.txq.pop(0)[1])
+
+    def run(self):
+        while self.running:
+            now = time.time()
+            self.poll(now)
+            deadlines = [t for t, _b in self.txq[0:1]]
+            if self.fire_end is not None:
+                deadlines.append(self.fire_end)
+            timeout = 0.05
+            if deadlines:
+                timeout = max(0.0, min(min(deadlines) - now, timeout))
+            readable, _w, _x = select.select([self.master], [], [], timeout)
+            if not readable:
+                continue
+            try:
+                buff = os.read(self.master, 256)
+            except OSError:
+                break
+            now = time.time()
+            self.rxbuf += buff
+            while b"\r" in self.rxbuf:
+                cmd, self.rxbuf = self.rxbuf.split(b"\r", 1)
+                cmd = cmd.decode("latin1").strip("\n")
+                if not cmd:
+                    continue
+                # Command isn't complete until its last byte arrived
+                self.rx_free = max(
+                    now, self.rx_free) + (len(cmd) + 1) * self.char_time
+                self.command(self.rx_free, cmd)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Hold the sensor open and serve captures to ham_raw.py / main.py --daemon
+"""
+
+from faxitron.util import add_bool_arg
+from faxitron import ham_daemon
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sensor capture daemon')
+    parser.add_argument('--verbose', action="store_true")
+    parser.add_argument('--exp', default=2000, type=int, help='Exposure ms')
+    parser.add_argument('--sock',
+                        default=ham_daemon.DEFAULT_SOCK,
+                        help='Unix socket file name')
+    add_bool_arg(parser,
+                 '--fast-init',
+                 default=None,
+                 help='Minimal sensor init, full init if it fails '
+                 '(default: FAXITRON_FAST_INIT)')
+    ctl = parser.add_mutually_exclusive_group()
+    ctl.add_argument('--quit',
+                     action="store_true",
+                     help='Stop a running daemon')
+    ctl.add_argument('--reset',
+                     action="store_true",
+                     help='Make a running daemon reinitialize the sensor')
+    args = parser.parse_args()
+
+    if args.quit or args.reset:
+        ham_daemon.command(args.sock, "quit" if args.quit else "reset")
+    else:
+        daemon = ham_daemon.HamDaemon(args.sock,
+                                      exp_ms=args.exp,
+                                      fast_init=args.fast_init,
+                                      verbose=args.verbose)
+        # Open now so the first capture doesn't pay for it
+        daemon.sensor()
+        daemon.run()
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
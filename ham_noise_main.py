@@ -3,6 +3,8 @@
 from faxitron.util import add_bool_arg, default_date_dir, mkdir_p
 from faxitron import xray
 from faxitron import ham
+from faxitron import writer
+from faxitron import ham_daemon
 import os
 import time
 
@@ -14,22 +16,19 @@ def run_cap(outdir,
             bin_out=False,
             png_out=True,
             exp=2000,
+            stream=False,
+            writers=0,
+            h=None,
+            daemon=None,
             verbose=False):
+    """
+    h: sensor to reuse across bursts, otherwise opened with open_sensor()
+    """
     if not outdir:
         outdir = default_date_dir("out", "", postfix)
 
-    def cap_cb(n, buff):
-        binfn = os.path.join(outdir, "%s%02u.bin" % (prefix, n))
-        pngfn = os.path.join(outdir, "%s%02u.png" % (prefix, n))
-
-        if bin_out:
-            print("Saving %s" % binfn)
-            open(binfn, 'w').write(buff)
-        if png_out:
-            print("Saving %s" % pngfn)
-            h.decode(buff).save(pngfn)
-
-    h = ham.Hamamatsu(verbose=verbose)
+    if h is None:
+        h = ham_daemon.open_sensor(daemon, verbose=verbose)
     mkdir_p(outdir)
     h.write_json(outdir)
     print("Setting exposure %u ms" % exp)
@@ -40,7 +39,14 @@ def run_cap(outdir,
         print('')
         print('')
 
-    h.cap(cap_cb, n=imgn)
+    with writer.FrameWriter(outdir,
+                            h.width,
+                            h.height,
+                            prefix=prefix,
+                            bin_out=bin_out,
+                            png_out=png_out,
+                            writers=writers) as cap_cb:
+        h.cap(cap_cb, n=imgn, stream=stream)
 
 
 def main():
@@ -63,6 +69,21 @@ def main():
     parser.add_argument('--postfix', default=None, help='')
     # Generally the center is the most interesting
     add_bool_arg(parser, "--raw", default=False)
+    parser.add_argument('--writers',
+                        default=0,
+                        type=int,
+                        help='Image writer pool size (0: write inline)')
+    add_bool_arg(parser,
+                 '--stream',
+                 default=False,
+                 help='Save images while capture is still running')
+    add_bool_arg(parser,
+                 '--daemon',
+                 default=False,
+                 help='Capture through a running ham_daemon.py')
+    parser.add_argument('--daemon-sock',
+                        default=ham_daemon.DEFAULT_SOCK,
+                        help='ham_daemon.py socket')
     parser.add_argument('fn_out', default=None, nargs='?', help='')
     args = parser.parse_args()
 
@@ -80,6 +101,10 @@ def main():
     else:
         xr = None
 
+    # Open once rather than re-initializing the sensor every burst
+    h = ham_daemon.open_sensor(args.daemon and args.daemon_sock,
+                               verbose=args.verbose)
+
     tnext = time.time()
     for capm in range(args.m):
         print("Waiting %u sec until next burst" % (time.time() - tnext, ))
@@ -96,7 +121,10 @@ def main():
                     prefix=prefix,
                     postfix=args.postfix,
                     imgn=args.n,
-                    exp=args.exp)
+                    exp=args.exp,
+                    stream=args.stream,
+                    writers=args.writers,
+                    h=h)
         # notably ^C can cause this
         finally:
             xr and xr.fire_abort(verbose=fire_verbose)
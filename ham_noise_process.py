@@ -10,6 +10,7 @@ from faxitron import ham
 from faxitron.im_util import make_bpm
 
 from PIL import Image, ImageOps
+import concurrent.futures
 import numpy as np
 import os
 import statistics
@@ -24,17 +25,61 @@ except ImportError:
     exposure = None
 
 
-def rms_npims(npims, npim_avg):
-    statef = np.zeros_like(npims[0])
-
-    for npim in npims:
-        x = (npim - npim_avg)
-        statef = statef + x * x
-
-    return np.sqrt(statef / len(npims))
-
-
-def run(dir_in, cal_dir=None, bpr=True):
+def burst_fns(din, bursti):
+    return list(glob.glob(os.path.join(din, "cap_%02u_*.png" % bursti)))
+
+
+def burst_stats(fns, bpm=None):
+    """
+    Stream a burst through a FrameAccumulator, reading each frame once
+    Return (average, RMS) per pixel arrays
+    """
+    acc = im_util.FrameAccumulator(minmax=False)
+    for fn in fns:
+        with Image.open(fn) as im:
+            npim = np.array(im)
+        if bpm:
+            npim = bpm.apply(npim)
+        acc.add(npim)
+    return acc.mean(), acc.rms()
+
+
+def burst_summary(fns, cal_dir=None, rms_bins=None):
+    """
+    Reduce a burst to the handful of numbers run() reports
+    Top level so it can run in a worker process, only the summary is sent back
+    cal_dir: do bad pixel replacement using this calibration
+    rms_bins: also return an RMS histogram over these bin edges
+    """
+    bpm = im_util.load_bpm(cal_dir) if cal_dir else None
+    npim_avg, npim_rms = burst_stats(fns, bpm=bpm)
+    ret = {
+        "avg_min": np.ndarray.min(npim_avg),
+        "avg_med": np.median(npim_avg),
+        "avg_max": np.ndarray.max(npim_avg),
+        "rms_min": np.ndarray.min(npim_rms),
+        "rms_med": np.median(npim_rms),
+        "rms_max": np.ndarray.max(npim_rms),
+    }
+    if rms_bins is not None:
+        ret["rms_hist"] = np.histogram(npim_rms.ravel(), bins=rms_bins)[0]
+    return ret
+
+
+def map_bursts(bursts, cal_dir=None, rms_bins=None, jobs=None):
+    """
+    Yield burst_summary() for each list of file names, in order
+    jobs: worker processes, default one per core. 1 to run in process
+    """
+    args = (bursts, [cal_dir] * len(bursts), [rms_bins] * len(bursts))
+    if jobs == 1 or len(bursts) <= 1:
+        yield from map(burst_summary, *args)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(burst_summary, *args)
+
+
+def run(dir_in, cal_dir=None, bpr=True, jobs=None, hist_dir=None):
     print('Processing %s' % dir_in)
 
     if not cal_dir:
@@ -44,31 +89,46 @@ def run(dir_in, cal_dir=None, bpr=True):
                   cal_dir)
             cal_dir = None
 
-    bursts = im_util.dir2np(dir_in, bpr=bpr, cal_dir=cal_dir)
+    bursts = []
+    while True:
+        fns = burst_fns(dir_in, len(bursts))
+        if not fns:
+            break
+        bursts.append(fns)
+
+    if bpr and cal_dir:
+        # Fail early rather than in every worker
+        im_util.load_bpm(cal_dir)
+        print("Loaded bad pixel map")
+    else:
+        cal_dir = None
+
+    rms_bins = None
+    if hist_dir:
+        rms_bins = range(0, 10, 1)
+        if not os.path.exists(hist_dir):
+            os.mkdir(hist_dir)
+
     rmss = []
     avgs = []
-    for bursti, npims in enumerate(bursts):
-
-        npim_avg = im_util.average_npimgs(npims)
-        avgs.append(np.median(npim_avg))
-
-        npim_rms = rms_npims(npims, npim_avg)
-        median_rms = np.median(npim_rms)
-        rmss.append(median_rms)
+    for bursti, summary in enumerate(
+            map_bursts(bursts, cal_dir=cal_dir, rms_bins=rms_bins, jobs=jobs)):
+        avgs.append(summary["avg_med"])
+        rmss.append(summary["rms_med"])
 
         print(
             "% 5u   avg min: % 5u, median: % 5u, max: % 5u      RMS min %0.6f med %0.6f max %0.6f"
-            % (bursti, np.ndarray.min(np.array(npim_avg)), np.median(npim_avg),
-               np.ndarray.max(np.array(npim_avg)), np.ndarray.min(npim_rms),
-               median_rms, np.ndarray.max(npim_rms)))
-        if 0:
+            % (bursti, summary["avg_min"], summary["avg_med"],
+               summary["avg_max"], summary["rms_min"], summary["rms_med"],
+               summary["rms_max"]))
+        if hist_dir:
             plt.clf()
-            plt.hist(npim_rms, bins=range(0, 10, 1))
+            plt.stairs(summary["rms_hist"], rms_bins)
             plt.title("histogram")
-            #plt.show()
-            plt.savefig("temp/rms_%02u.png" % bursti)
+            plt.savefig(os.path.join(hist_dir, "rms_%02u.png" % bursti))
 
     if len(avgs) > 1:
+        plt.clf()
         plt.plot(avgs)
         plt.show()
 
@@ -79,10 +139,18 @@ def main():
     parser = argparse.ArgumentParser(description='Calculate RMS noise')
     parser.add_argument('--cal-dir', default='cal', help='')
     add_bool_arg(parser, "--bpr", default=True)
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=None,
+                        help='Bursts to process in parallel (default: cores)')
+    parser.add_argument('--hist-dir',
+                        default=None,
+                        help='Save a per burst RMS histogram plot here')
     parser.add_argument('dir_in', help='')
     args = parser.parse_args()
 
-    run(args.dir_in, bpr=args.bpr)
+    run(args.dir_in, bpr=args.bpr, jobs=args.jobs, hist_dir=args.hist_dir)
 
     print("done")
 
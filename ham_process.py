@@ -12,6 +12,8 @@ from faxitron.util import add_bool_arg
 from faxitron import util
 from faxitron import im_util
 from faxitron import ham
+from faxitron import burst
+from faxitron import clahe
 
 from PIL import Image, ImageOps
 import numpy as np
@@ -19,6 +21,10 @@ import os
 import subprocess
 import json
 import shutil
+import sys
+import time
+import glob
+import concurrent.futures
 
 try:
     from skimage import exposure
@@ -26,6 +32,47 @@ except ImportError:
     exposure = None
 
 
+def print_minmax(label, npim):
+    print("%s min: %u, max: %u" % (label, np.min(npim), np.max(npim)))
+
+
+def timed(label, f, *args, **kwargs):
+    tstart = time.time()
+    ret = f(*args, **kwargs)
+    print("%s: %0.3f sec" % (label, time.time() - tstart))
+    return ret
+
+
+def hist_eq_np(wip, hist_eq_roi=None):
+    if hist_eq_roi:
+        print("Using ROI %s" % (hist_eq_roi, ))
+        x1, y1, x2, y2 = hist_eq_roi
+        ref_np2 = wip[y1:y2, x1:x2]
+    else:
+        ref_np2 = wip
+    return im_util.histeq_lut(wip, ref=ref_np2)
+
+
+def default_fns_out(dir_in):
+    """Return (image, hist eq image) output file names for capture dir"""
+    dir_in = dir_in.rstrip('/')
+    return dir_in + '.png', dir_in + '_e.png'
+
+
+def find_cal_dir(dir_in, cal_dir=None, verbose=True):
+    if not cal_dir:
+        cal_dir = im_util.default_cal_dir(im_dir=dir_in)
+        if not os.path.exists(cal_dir):
+            print("WARNING: default calibration dir %s does not exist" %
+                  cal_dir)
+            cal_dir = None
+
+    if cal_dir:
+        assert os.path.exists(cal_dir)
+        verbose and print("Found calibration files at %s" % cal_dir)
+    return cal_dir
+
+
 def run(dir_in,
         fn_out,
         cal_dir=None,
@@ -40,76 +87,42 @@ def run(dir_in,
         dir_in = dir_in
         if dir_in[-1] == '/':
             dir_in = dir_in[:-1]
-        fn_out = dir_in + '.png'
-        fn_oute = dir_in + '_e.png'
+        fn_out, fn_oute = default_fns_out(dir_in)
     else:
         fn_out = fn_out
         fn_oute = fn_out
 
-    _imgn, img_in = im_util.average_dir(dir_in, scalar=scalar)
+    # Work on a single uint16 array, only converting to PIL to save
+    statef = timed("Average", im_util.average_dir_np, dir_in, scalar=scalar)
+    wip = im_util.npf2u16(statef)
+    del statef
 
     desc = dir_in
     print('Processing %s' % desc)
 
-    im_wip = img_in
-    print("Avg min: %u, max: %u" %
-          (np.ndarray.min(np.array(im_wip)), np.ndarray.max(np.array(im_wip))))
+    print_minmax("Avg", wip)
     if not raw:
-        if not cal_dir:
-            cal_dir = im_util.default_cal_dir(im_dir=dir_in)
-            if not os.path.exists(cal_dir):
-                print("WARNING: default calibration dir %s does not exist" %
-                      cal_dir)
-                cal_dir = None
+        cal_dir = find_cal_dir(dir_in, cal_dir)
 
-        if cal_dir:
-            assert os.path.exists(cal_dir)
-            print("Found calibration files at %s" % cal_dir)
-
-        if rescale and cal_dir:
-            ffimg = Image.open(os.path.join(cal_dir, 'ff.png'))
-            np_ff2 = np.array(ffimg)
-            dfimg = Image.open(os.path.join(cal_dir, 'df.png'))
-            np_df2 = np.array(dfimg)
-
-            # ff *should* be brighter than df
-            # (due to .png pixel value inversion convention)
-            mins = np.minimum(np_df2, np_ff2)
-            maxs = np.maximum(np_df2, np_ff2)
-
-            u16_mins = np.full(mins.shape, 0x0000, dtype=np.dtype('float'))
-            u16_ones = np.full(mins.shape, 0x0001, dtype=np.dtype('float'))
-            u16_maxs = np.full(mins.shape, 0xFFFF, dtype=np.dtype('float'))
-
-            cal_det = maxs - mins
-            # Prevent div 0 on bad pixels
-            cal_det = np.maximum(cal_det, u16_ones)
-            cal_scalar = 0xFFFF / cal_det
-
-            np_in2 = np.array(im_wip)
-            np_scaled = (np_in2 - mins) * cal_scalar
-            # If it clipped, squish to good values
-            np_scaled = np.minimum(np_scaled, u16_maxs)
-            np_scaled = np.maximum(np_scaled, u16_mins)
-            im_wip = Image.fromarray(np_scaled).convert("I")
-            print("Rescale min: %u, max: %u" % (np.ndarray.min(
-                np.array(im_wip)), np.ndarray.max(np.array(im_wip))))
+        cal = None
+        if cal_dir and (rescale or bpr):
+            cal = timed("Load cal", im_util.load_cal, cal_dir)
+
+        if rescale and cal:
+            wip = timed("Rescale", cal.rescale, wip)
+            print_minmax("Rescale", wip)
 
         # Seems this needs to be done after scaling or artifacts get amplified
-        if bpr and cal_dir:
-            badimg = Image.open(os.path.join(cal_dir, 'bad.png'))
-            im_wip = im_util.do_bpr(im_wip, badimg)
-            print("BPR min: %u, max: %u" % (np.ndarray.min(
-                np.array(im_wip)), np.ndarray.max(np.array(im_wip))))
+        if bpr and cal:
+            assert cal.bpm, "Missing bad.png"
+            wip = timed("BPR", cal.bpm.apply, wip)
+            print_minmax("BPR", wip)
 
         if invert:
-            # IOError("not supported for this image mode")
-            # im_wip = ImageOps.invert(im_wip)
-            im_wip = im_util.im_inv16_slow(im_wip)
-            print("Invert min: %u, max: %u" % (np.ndarray.min(
-                np.array(im_wip)), np.ndarray.max(np.array(im_wip))))
+            timed("Invert", im_util.np_inv16, wip, out=wip)
+            print_minmax("Invert", wip)
     print("Save %s" % fn_out)
-    im_wip.save(fn_out)
+    timed("Save", im_util.npi2im(wip).save, fn_out)
 
     # https://stackoverflow.com/questions/43569566/adaptive-histogram-equalization-in-python
     # simple implementation
@@ -118,55 +131,139 @@ def run(dir_in,
     if hist_eq:
         mode = os.getenv("FAXITRON_EQ_MODE", "0")
         print("Eq mode (FAXITRON_EQ_MODE) %s" % mode)
+        tstart = time.time()
         if mode == "0":
-            if hist_eq_roi:
-                print("Using ROI %s" % (hist_eq_roi, ))
-                x1, y1, x2, y2 = hist_eq_roi
-                ref_im = im_wip.crop((x1, y1, x2, y2))
-            else:
-                ref_im = im_wip
-
-            ref_np2 = np.array(ref_im)
-            wip_np2 = np.array(im_wip)
-            wip_np2 = im_util.histeq_np_apply(
-                wip_np2, im_util.histeq_np_create(ref_np2))
-            im_wip = im_util.npf2im(wip_np2)
+            wip = hist_eq_np(wip, hist_eq_roi=hist_eq_roi)
         elif mode == "convert":
-            with util.AutoTempFN(suffix='.png') as tmpa:
-                with util.AutoTempFN(suffix='.png') as tmpb:
-                    im_wip.save(tmpa)
-                    subprocess.check_call(
-                        "convert %s \( +clone -equalize \) -average %s" %
-                        (tmpa, tmpb),
-                        shell=True)
-                    im_wip = Image.open(tmpb)
+            wip = im_util.histeq_convert(wip)
+        elif mode == "convert_ext":
+            wip = im_util.histeq_convert_ext(wip)
         elif mode == "1":
             # OSError: not supported for this image mode
-            im_wip = ImageOps.equalize(im_wip, mask=None)
+            wip = np.array(ImageOps.equalize(im_util.npi2im(wip), mask=None),
+                           dtype=np.uint16)
         elif mode == "2":
-            imnp = np.array(im_wip, dtype=np.uint16)
-            im_wip = im_util.npf2im(exposure.equalize_hist(imnp))
+            wip = im_util.npf2u16(exposure.equalize_hist(wip))
         elif mode == "3":
-            # raise ValueError("Images of type float must be between -1 and 1.")
-            imnp = np.array(im_wip, dtype=np.uint16)
-            #imnp = np.ndarray.astype(imnp, dtype=float)
-            print(np.ndarray.min(imnp), np.ndarray.max(imnp))
-            imnp = 1.0 * imnp / 0xFFFF
-            im_wip = im_util.npf2im(
-                exposure.equalize_adapthist(imnp, clip_limit=0.03))
+            # Adaptive (CLAHE)
+            clip_limit = float(os.getenv("FAXITRON_CLAHE_CLIP", "0.03"))
+            tile = int(os.getenv("FAXITRON_CLAHE_TILE", "0"))
+            print("CLAHE clip limit %s, tile %s" % (clip_limit, tile or "1/8"))
+            wip = clahe.clahe(wip, clip_limit=clip_limit, tile=tile)
         else:
             raise Exception(mode)
+        print("Eq: %0.3f sec" % (time.time() - tstart, ))
         print("Save %s" % fn_oute)
-        im_wip.save(fn_oute)
-        print("Eq min: %u, max: %u" % (np.ndarray.min(
-            np.array(im_wip)), np.ndarray.max(np.array(im_wip))))
+        timed("Save", im_util.npi2im(wip).save, fn_oute)
+        print_minmax("Eq", wip)
 
     # In practice I want to bind cal files to the images
     # Cache it here to make sure they stay together
     if cal_dir:
         cal_backup = os.path.join(dir_in, "cal")
         if not os.path.exists(cal_backup):
-            shutil.copytree(cal_dir, cal_backup)
+            # Compiled cache is large and can be regenerated
+            shutil.copytree(cal_dir,
+                            cal_backup,
+                            ignore=shutil.ignore_patterns(
+                                im_util.CAL_CACHE_FN))
+
+
+def batch_dirs(patterns):
+    """Expand directories / globs into capture directories"""
+    ret = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        for d in matches:
+            d = d.rstrip('/')
+            if os.path.isdir(d) and os.path.exists(
+                    os.path.join(d, "sensor.json")) and d not in ret:
+                ret.append(d)
+    return ret
+
+
+def up_to_date(dir_in, cal_dir=None, hist_eq=True):
+    """True if outputs are newer than the captured images and calibration"""
+    fn_out, fn_oute = default_fns_out(dir_in)
+    fns_out = [fn_out]
+    if hist_eq:
+        fns_out.append(fn_oute)
+    if not all([os.path.exists(fn) for fn in fns_out]):
+        return False
+    out_mtime = min([os.path.getmtime(fn) for fn in fns_out])
+
+    fns_in = glob.glob(os.path.join(dir_in, "cap_*.png"))
+    fns_in += glob.glob(os.path.join(dir_in, burst.BURST_FN))
+    fns_in.append(os.path.join(dir_in, "sensor.json"))
+    if cal_dir:
+        fns_in += [
+            os.path.join(cal_dir, fn)
+            for fn, _mtime, _size in im_util.cal_sources(cal_dir)
+        ]
+    in_mtime = max([os.path.getmtime(fn) for fn in fns_in])
+    return out_mtime > in_mtime
+
+
+def run_batch_dir(dir_in, kwargs):
+    """Process pool entry point"""
+    run(dir_in, None, **kwargs)
+    return dir_in
+
+
+def run_batch(patterns, jobs=1, force=False, **kwargs):
+    """
+    Process many capture directories, skipping ones that are up to date
+    kwargs: passed to run()
+    """
+    dirs = batch_dirs(patterns)
+    print("Batch: %u directories" % len(dirs))
+    todo = []
+    cal_dirs = set()
+    for dir_in in dirs:
+        cal_dir = None
+        if not kwargs.get("raw"):
+            cal_dir = find_cal_dir(dir_in,
+                                   kwargs.get("cal_dir"),
+                                   verbose=False)
+        if not force and up_to_date(
+                dir_in, cal_dir=cal_dir, hist_eq=kwargs.get("hist_eq", True)):
+            print("Skip %s: up to date" % dir_in)
+            continue
+        todo.append(dir_in)
+        if cal_dir:
+            cal_dirs.add(cal_dir)
+
+    # Compile each calibration once here so workers only load cal.npz
+    for cal_dir in sorted(cal_dirs):
+        im_util.load_cal(cal_dir)
+
+    tstart = time.time()
+    failed = []
+    if jobs > 1 and len(todo) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs) as executor:
+            futures = dict([(executor.submit(run_batch_dir, dir_in,
+                                             kwargs), dir_in)
+                            for dir_in in todo])
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("ERROR: %s: %s" % (futures[future], e))
+                    failed.append(futures[future])
+    else:
+        for dir_in in todo:
+            try:
+                run_batch_dir(dir_in, kwargs)
+            except Exception as e:
+                print("ERROR: %s: %s" % (dir_in, e))
+                failed.append(dir_in)
+    print("Batch: processed %u / %u directories in %0.1f sec, %u failed" %
+          (len(todo) - len(failed), len(dirs), time.time() - tstart,
+           len(failed)))
+    for dir_in in sorted(failed):
+        print("  failed: %s" % dir_in)
+    return failed
 
 
 def main():
@@ -187,20 +284,42 @@ def main():
     add_bool_arg(parser, "--bpr", default=True)
     add_bool_arg(parser, "--raw", default=False)
     parser.add_argument('--scalar', default=None, type=float, help='')
-    parser.add_argument('dir_in', help='')
-    parser.add_argument('fn_out', default=None, nargs='?', help='')
+    parser.add_argument('--batch',
+                        action="store_true",
+                        help='Process many dirs / globs (ex: "out/*")')
+    parser.add_argument('-j',
+                        default=1,
+                        type=int,
+                        help='Batch mode parallel jobs')
+    parser.add_argument('--force',
+                        action="store_true",
+                        help='Batch mode: process even if up to date')
+    parser.add_argument('dir_in',
+                        nargs='+',
+                        help='dir_in [fn_out], or with --batch dirs / globs')
     args = parser.parse_args()
 
-    run(args.dir_in,
-        args.fn_out,
-        cal_dir=args.cal_dir,
-        hist_eq=args.hist_eq,
-        invert=args.invert,
-        hist_eq_roi=im_util.parse_roi(args.hist_eq_roi),
-        scalar=args.scalar,
-        rescale=args.rescale,
-        bpr=args.bpr,
-        raw=args.raw)
+    kwargs = dict(cal_dir=args.cal_dir,
+                  hist_eq=args.hist_eq,
+                  invert=args.invert,
+                  hist_eq_roi=im_util.parse_roi(args.hist_eq_roi),
+                  scalar=args.scalar,
+                  rescale=args.rescale,
+                  bpr=args.bpr,
+                  raw=args.raw)
+    if args.batch:
+        failed = run_batch(args.dir_in,
+                           jobs=args.j,
+                           force=args.force,
+                           **kwargs)
+        if failed:
+            sys.exit(1)
+    else:
+        if len(args.dir_in) > 2:
+            parser.error("expect dir_in [fn_out] (use --batch for many dirs)")
+        dir_in = args.dir_in[0]
+        fn_out = args.dir_in[1] if len(args.dir_in) > 1 else None
+        run(dir_in, fn_out, **kwargs)
 
     print("done")
 
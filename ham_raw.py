@@ -7,6 +7,9 @@ from faxitron.util import add_bool_arg, default_date_dir, mkdir_p
 from PIL import Image
 import os
 from faxitron import ham
+from faxitron import writer
+from faxitron import burst
+from faxitron import ham_daemon
 import glob
 
 
@@ -16,22 +19,17 @@ def run(outdir,
         bin_out=False,
         png_out=True,
         exp=2000,
+        stream=False,
+        writers=0,
+        writer_procs=False,
+        burst_out=False,
+        kvp=0,
+        daemon=None,
         verbose=False):
     if not outdir:
         outdir = default_date_dir("out", "", postfix)
 
-    def cap_cb(n, buff):
-        binfn = os.path.join(outdir, "cap_%02u.bin" % n)
-        pngfn = os.path.join(outdir, "cap_%02u.png" % n)
-
-        if bin_out:
-            print("Saving %s" % binfn)
-            open(binfn, 'wb').write(buff)
-        if png_out:
-            print("Saving %s" % pngfn)
-            h.decode(buff).save(pngfn)
-
-    h = ham.Hamamatsu(verbose=verbose)
+    h = ham_daemon.open_sensor(daemon, verbose=verbose)
     mkdir_p(outdir)
     h.write_json(outdir)
     print("Setting exposure %u ms" % exp)
@@ -42,7 +40,33 @@ def run(outdir,
         print('')
         print('')
 
-    h.cap(cap_cb, n=imgn)
+    bw = None
+    if burst_out:
+        sensor = h.get_json()
+        # Start a new burst so it matches the .png's written below
+        bw = burst.BurstWriter(os.path.join(outdir, burst.BURST_FN),
+                               h.width,
+                               h.height,
+                               depth=h.depth,
+                               exp_ms=exp,
+                               kvp=kvp,
+                               model=sensor["model"],
+                               sn=sensor["sn"],
+                               append=False)
+
+    # Returns only after every file has been written
+    with writer.FrameWriter(outdir,
+                            h.width,
+                            h.height,
+                            prefix="cap_",
+                            bin_out=bin_out,
+                            png_out=png_out,
+                            writers=writers,
+                            processes=writer_procs,
+                            burst=bw) as cap_cb:
+        tstart = time.time()
+        h.cap(cap_cb, n=imgn, stream=stream, meta=True)
+        print("Capture: %0.3f sec" % (time.time() - tstart, ))
 
 
 def main():
@@ -62,6 +86,29 @@ def main():
     parser.add_argument('-n', default=1, type=int, help='Number images')
     parser.add_argument('--exp', default=2000, type=int, help='Exposure ms')
     parser.add_argument('--postfix', default=None, help='')
+    add_bool_arg(parser,
+                 '--stream',
+                 default=False,
+                 help='Save images while capture is still running')
+    parser.add_argument('--writers',
+                        default=0,
+                        type=int,
+                        help='Image writer pool size (0: write inline)')
+    add_bool_arg(parser,
+                 '--writer-procs',
+                 default=False,
+                 help='Use processes instead of threads for writers')
+    add_bool_arg(parser,
+                 '--burst',
+                 default=False,
+                 help='Also append raw frames to single file cap.raw')
+    add_bool_arg(parser,
+                 '--daemon',
+                 default=False,
+                 help='Capture through a running ham_daemon.py')
+    parser.add_argument('--daemon-sock',
+                        default=ham_daemon.DEFAULT_SOCK,
+                        help='ham_daemon.py socket')
     args = parser.parse_args()
 
     run(args.dir,
@@ -70,6 +117,11 @@ def main():
         bin_out=args.bin,
         png_out=args.png,
         exp=args.exp,
+        stream=args.stream,
+        writers=args.writers,
+        writer_procs=args.writer_procs,
+        burst_out=args.burst,
+        daemon=args.daemon and args.daemon_sock,
         verbose=args.verbose)
 
 
@@ -4,6 +4,7 @@ from faxitron.util import add_bool_arg, default_date_dir, mkdir_p
 from faxitron import util
 from faxitron import im_util
 from faxitron import xray
+from faxitron import ham_daemon
 import ham_raw
 import ham_process
 import os
@@ -37,6 +38,25 @@ def main():
                         help='hist eq x1,y1,x2,y2')
     add_bool_arg(parser, "--hist-eq", default=True)
     add_bool_arg(parser, "--raw", default=False)
+    parser.add_argument('--writers',
+                        default=0,
+                        type=int,
+                        help='Image writer pool size (0: write inline)')
+    add_bool_arg(parser,
+                 '--stream',
+                 default=False,
+                 help='Save images while capture is still running')
+    add_bool_arg(parser,
+                 '--burst',
+                 default=False,
+                 help='Also append raw frames to single file cap.raw')
+    add_bool_arg(parser,
+                 '--daemon',
+                 default=False,
+                 help='Capture through a running ham_daemon.py')
+    parser.add_argument('--daemon-sock',
+                        default=ham_daemon.DEFAULT_SOCK,
+                        help='ham_daemon.py socket')
     parser.add_argument('fn_out', default=None, nargs='?', help='')
     args = parser.parse_args()
 
@@ -60,7 +80,12 @@ def main():
         ham_raw.run(outdir=outdir,
                     postfix=args.postfix,
                     imgn=args.n,
-                    exp=args.exp)
+                    exp=args.exp,
+                    stream=args.stream,
+                    writers=args.writers,
+                    burst_out=args.burst,
+                    kvp=args.kvp,
+                    daemon=args.daemon and args.daemon_sock)
     # notably ^C can cause this
     finally:
         xr and xr.fire_abort(verbose=fire_verbose)
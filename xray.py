@@ -29,6 +29,10 @@ def main():
         print("State: %s" % xr.get_state())
         print("Exposure time %u ds" % xr.get_timed())
         print("kVp %u" % xr.get_kvp())
+        stats = xr.latency_stats()
+        print("Serial: %u replies, latency mean %0.1f ms, max %0.1f ms" %
+              (stats["replies"], stats["latency_mean"] * 1000,
+               stats["latency_max"] * 1000))
 
     if args.remote:
         xr.mode_remote()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Run a software x-ray controller on a pty until ^C
+Point xray.py / main.py --port at the printed device
+"""
+
+from faxitron import xray_emu
+import time
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Emulate Faxitron x-ray unit')
+    parser.add_argument('--verbose', action="store_true")
+    parser.add_argument('--model', default="DX-50", help='DX-50 or MX-20')
+    parser.add_argument('--baud',
+                        default=9600,
+                        type=int,
+                        help='Emulated line rate (0: instant)')
+    parser.add_argument('--delay',
+                        default=0.01,
+                        type=float,
+                        help='Seconds before each reply')
+    parser.add_argument('--ff-rate',
+                        default=0.0,
+                        type=float,
+                        help='Chance of 0xFF glitch byte per reply')
+    parser.add_argument('--drop-rate',
+                        default=0.0,
+                        type=float,
+                        help='Chance a command is ignored')
+    parser.add_argument('--warmup',
+                        default=0.0,
+                        type=float,
+                        help='Seconds to report warming up')
+    args = parser.parse_args()
+
+    with xray_emu.XRayEmulator(model=args.model,
+                               baud=args.baud,
+                               reply_delay=args.delay,
+                               ff_rate=args.ff_rate,
+                               drop_rate=args.drop_rate,
+                               warmup=args.warmup,
+                               verbose=args.verbose) as emu:
+        print("Emulating %s on %s" % (args.model, emu.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        print(emu.stats)
+
+    print("done")
+
+
+if __name__ == "__main__":
+    main()